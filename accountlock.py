@@ -0,0 +1,122 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+
+
+
+class AccountLocked(Exception):
+    pass
+
+
+
+class AccountLock(object):
+    """Advisory lock (flock) on a file in the account state directory, so that
+    overlapping runs for the same account don't log in, download and send the
+    same courriers twice.
+
+    The lock file holds the pid, host and start time of the holder. It's
+    emptied on release, so a non-empty file found when acquiring the lock was
+    left by a process that died. The lock is never broken: the flock of a
+    process that died is released, so a held flock means its holder is
+    alive, whatever the file says. The file may still describe the previous
+    holder while a new one is between getting the flock and writing it. A
+    holder older than maxage seconds is only reported."""
+
+    def __init__(self, path, timeout=0, maxage=6 * 3600):
+        self._path = path
+        self._timeout = timeout
+        self._maxage = maxage
+        self._fd = None
+
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+
+    @staticmethod
+    def _readholder(fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = os.read(fd, 4096)
+        if not data:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return {}
+
+
+
+    @staticmethod
+    def _describe(holder):
+        desc = "pid %s on %s" % (holder.get("pid"), holder.get("host"))
+        if "since" in holder:
+            desc += " for %ds" % (time.time() - holder["since"])
+        return desc
+
+
+
+    def _trylock(self):
+        """Return the locked fd, or the holder description if it's busy."""
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            holder = self._readholder(fd) or {}
+            os.close(fd)
+            return None, holder
+
+        return fd, None
+
+
+
+    def acquire(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        deadline = time.monotonic() + self._timeout
+        warned = False
+
+        while True:
+            fd, holder = self._trylock()
+            if fd is not None:
+                break
+
+            if not warned and time.time() - holder.get("since", time.time()) > self._maxage:
+                warned = True
+                logging.warning("Lock %s held by %s, the holder may be stuck", self._path, self._describe(holder))
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AccountLocked("Account lock %s held by %s" % (self._path, self._describe(holder)))
+
+            logging.info("Waiting for lock %s held by %s", self._path, self._describe(holder))
+            time.sleep(min(1, remaining))
+
+        previous = self._readholder(fd)
+        if previous:
+            logging.warning("Lock %s was not released by pid %s", self._path, previous.get("pid"))
+
+        me = {"pid": os.getpid(), "host": socket.gethostname(), "since": time.time()}
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, json.dumps(me).encode(), 0)
+        self._fd = fd
+        logging.debug("Acquired lock %s", self._path)
+
+
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        logging.debug("Released lock %s", self._path)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+# Cumulative import time budget of each entry point, in milliseconds
+BUDGETS = {
+    "autovalidate": 40,
+    "mailmessages": 40,
+    "paulemploi": 40,
+    "workfile": 20,
+    "search": 40,
+}
+
+# Modules the main() of an entry point imports before doing anything, the
+# compatibility scripts only run paulemploi
+MAINIMPORTS = {
+    "autovalidate": ["paulemploi"],
+    "mailmessages": ["paulemploi"],
+}
+
+# Modules that shouldn't be loaded just by starting a script and setting up
+# the logging with stderr not being a TTY
+HEAVY = ["lxml", "cssselect", "requests", "retrying", "colorama", "smtplib", "email.message"]
+
+STARTUP = """
+import logging.config, sys
+import %s
+logging.config.fileConfig("logconf.ini", disable_existing_loggers=False)
+print(" ".join(m for m in %r if m in sys.modules))
+"""
+
+
+
+def importtime(module):
+    """Run a fresh interpreter importing module and the modules its main()
+    imports. Return their cumulative import time in microseconds and the
+    heavy modules loaded."""
+
+    modules = [module] + MAINIMPORTS.get(module, [])
+    code = STARTUP % (", ".join(modules), HEAVY)
+    cmd = [sys.executable, "-X", "importtime", "-c", code]
+    res = subprocess.run(cmd, cwd=SELFPATH, capture_output=True, text=True, check=True)
+
+    # Each module is only counted for what the previous ones didn't import
+    cumulative = 0
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        # Nested imports are indented
+        if fields[2].rstrip()[1:] in modules:
+            cumulative += int(fields[1])
+
+    return cumulative, res.stdout.split()
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mesure le temps d'import des scripts")
+    parser.add_argument("--runs", "-r", type=int, default=5, help="Nombre de mesures par script")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplie les budgets (machines lentes)")
+
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in sorted(BUDGETS.items()):
+        budget *= args.scale
+        times = []
+        for _ in range(args.runs):
+            us, heavy = importtime(module)
+            times.append(us)
+
+        best = min(times) / 1000
+        status = "ok"
+        if best > budget:
+            status = "OVER BUDGET"
+            failed = True
+        if heavy:
+            status += ", loads " + " ".join(heavy)
+            failed = True
+
+        print("%-15s %7.2f ms (budget %.0f ms) %s" % (module, best, budget, status))
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""Compiled schema of the actualisation form.
+
+The schema (paul.SCHEMA) tells the question expected for each block of the
+form. It's compiled once into CSS selectors. Each form is reduced to a
+structural description (blocks, containers, questions and inputs) whose hash
+is the fingerprint of the form. Filling a form fully validates it against the
+schema and produces a field map: the input name, type and values of each
+block and the blocks each answer opens. Field maps are cached on disk by
+fingerprint so that a form identical to one already validated is filled
+without looking at its blocks again."""
+
+import difflib
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+# lxml is imported where it's used
+
+
+
+class FormSchema(object):
+    # Top-level question blocks
+    TOPLEVEL = "div:not(.hide) > fieldset:not([id]) > div.form-line:not(.js-hide)"
+
+    def __init__(self, schema):
+        from lxml.cssselect import CSSSelector
+
+        self.questions = {blocid: q['question'] for blocid, q in schema.items()}
+        self._toplevel = CSSSelector(self.TOPLEVEL)
+        self._lines = CSSSelector("div.form-line")
+        self._titles = CSSSelector(".label > .list-title")
+        self._labels = CSSSelector(".label > label")
+        self._inputs = CSSSelector("input")
+        self._questionre = re.compile(r'^\s*(.*?)\s*(?:Aide\s*)?$', re.MULTILINE)
+
+
+
+    def _question(self, bloc):
+        import lxml.html
+
+        qs = self._titles(bloc)
+        if len(qs) == 0:
+            qs = self._labels(bloc)
+        if len(qs) != 1:
+            return None
+
+        q = lxml.html.tostring(qs[0], method='text', encoding='unicode')
+        return self._questionre.match(q).group(1)
+
+
+
+    @staticmethod
+    def _opens(input_):
+        """Id of the block shown when this input is checked, if any."""
+        if "js-open" not in input_.classes:
+            return None
+        inputid = input_.get('id') or ""
+        if not inputid.endswith("-open"):
+            return None
+        return inputid[:-len("-open")]
+
+
+
+    def _openids(self, form):
+        """Ids of the blocks that some input of the form can open."""
+        return set(filter(None, (self._opens(i) for i in self._inputs(form))))
+
+
+
+    @staticmethod
+    def _container(bloc, openids):
+        """Nearest block containing bloc that an input opens."""
+        for parent in bloc.iterancestors():
+            if parent.get('id') in openids:
+                return parent
+        return None
+
+
+
+    def _children(self, container, openids):
+        """Question blocks directly shown by an opened block, not those of
+        the opened blocks nested in it."""
+        return [b for b in self._lines(container) if self._container(b, openids) is container]
+
+
+
+    def describe(self, form):
+        """Structural description of a form, one line per question block."""
+        toplevel = set(self._toplevel(form))
+        openids = self._openids(form)
+        lines = []
+
+        for bloc in self._lines(form):
+            if bloc in toplevel:
+                where = "/"
+            else:
+                container = self._container(bloc, openids)
+                where = "#" + container.get('id', "?") if container is not None else "?"
+
+            inputs = []
+            for i in self._inputs(bloc):
+                desc = "%s:%s=%s" % (i.get('type', "text").lower(), i.get('name'), i.get('value', ""))
+                openid = self._opens(i)
+                if openid is not None:
+                    desc += ">" + openid
+                inputs.append(desc)
+
+            lines.append("%s %s %r %s" % (where, bloc.get('id'), self._question(bloc), " ".join(inputs)))
+
+        return lines
+
+
+
+    @staticmethod
+    def fingerprint(description):
+        return hashlib.sha256("\n".join(description).encode()).hexdigest()
+
+
+
+    def _validate_block(self, bloc, answers):
+        """Check a question block against the schema and return its field
+        description along with the id of the block our answer opens."""
+        import lxml.html
+
+        blocid = bloc.get('id')
+        logging.debug("Validating block %s", blocid)
+
+        q = self._question(bloc)
+        if q is None:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("Expected one question in block '%s'\nPlease check the form yourself:\n%s" % (blocid, blocstr))
+        logging.debug("Answering question %r", q)
+
+        if blocid not in self.questions:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("Unknown question block: %s" % blocstr)
+
+        if self.questions[blocid] != q:
+            raise ValueError("Question changed for block '%s'. Expected %r found %r" % (blocid, self.questions[blocid], q))
+
+        inputs = self._inputs(bloc)
+        inputnames = set(i.name for i in inputs)
+        if len(inputnames) == 0:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("No input in block '%s'\nPlease check the form yourself:\n%s" % (blocid, blocstr))
+
+        if len(inputnames) > 1:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("Several inputs for question %r\nPlease check the form yourself:\n%s" % (q, blocstr))
+
+        inputtype = inputs[0].type.lower()
+
+        if inputtype not in ("text", "radio"):
+            raise ValueError("Found an input with type %r. Those aren't supported yet." % inputtype)
+
+        field = {"name": inputs[0].name, "type": inputtype, "values": [], "opens": {}}
+        if inputtype == "text":
+            return field, None
+
+        for i in inputs:
+            field["values"].append(i.get("value"))
+            openid = self._opens(i)
+            if openid is not None:
+                field["opens"][i.get("value")] = openid
+
+        # Check that our answer doesn't show a new question
+        matching = [i for i in inputs if i.get("value") == answers[blocid]]
+        if len(matching) == 0:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("No input for question %r with value %r. Possible values are %r\nPlease check the form yourself:\n%s" % (q, answers[blocid], field["values"], blocstr))
+
+        if len(matching) > 1:
+            blocstr = lxml.html.tostring(bloc, encoding='unicode')
+            raise ValueError("Several inputs for question %r with value %r.\nPlease check the form yourself:\n%s" % (q, answers[blocid], blocstr))
+
+        openid = field["opens"].get(answers[blocid])
+        if openid is not None:
+            logging.debug("Answering %r to question %r opens block %r.", answers[blocid], q, openid)
+
+        return field, openid
+
+
+
+    def validate(self, form, answers):
+        """Fully validate the form against the schema while filling it.
+        Return the form values and the field map of the blocks visited."""
+        import lxml.html
+
+        formvalues = dict(form.fields)
+        fieldmap = {"top": [], "fields": {}, "children": {}}
+        openids = self._openids(form)
+
+        def fill(blocs, opened):
+            blocids = []
+            for bloc in blocs:
+                blocid = bloc.get('id')
+                field, openid = self._validate_block(bloc, answers)
+                fieldmap["fields"][blocid] = field
+                formvalues[field["name"]] = answers[blocid]
+                blocids.append(blocid)
+
+                if openid is None:
+                    continue
+
+                if openid in opened:
+                    raise ValueError("Question block '%s' opens block '%s' which is already open" % (blocid, openid))
+
+                blocshow = form.cssselect("#" + openid)
+                if len(blocshow) == 0:
+                    raise ValueError("Block '%s' should be shown but doesn't exist" % openid)
+
+                children = self._children(blocshow[0], openids)
+                if len(children) == 0:
+                    blocstr = lxml.html.tostring(blocshow[0], encoding='unicode')
+                    raise ValueError("No question in block '%s' opened by block '%s'\nPlease check the form yourself:\n%s" % (openid, blocid, blocstr))
+
+                fieldmap["children"][openid] = fill(children, opened | {openid})
+            return blocids
+
+        fieldmap["top"] = fill(self._toplevel(form), frozenset())
+        return formvalues, fieldmap
+
+
+
+    @staticmethod
+    def fill(form, fieldmap, answers):
+        """Fill the form from a field map, without looking at its blocks.
+        Return None if an answer leads to a part of the form the field map
+        doesn't cover."""
+        formvalues = dict(form.fields)
+
+        def fill(blocids):
+            for blocid in blocids:
+                field = fieldmap["fields"][blocid]
+                value = answers[blocid]
+                if field["type"] == "radio" and value not in field["values"]:
+                    return False
+
+                formvalues[field["name"]] = value
+                openid = field["opens"].get(value)
+                if openid is None:
+                    continue
+                if openid not in fieldmap["children"] or not fill(fieldmap["children"][openid]):
+                    return False
+            return True
+
+        if not fill(fieldmap["top"]):
+            return None
+        return formvalues
+
+
+
+class FormCache(object):
+    """Field maps of the forms already validated, stored by fingerprint in a
+    JSON file along with the form descriptions to diff against."""
+
+    maxforms = 8
+
+    def __init__(self, path):
+        self._path = path
+
+
+
+    def _load(self):
+        if self._path is None:
+            return {}
+        try:
+            with open(self._path) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable form cache %s: %s", self._path, e)
+            return {}
+
+
+
+    def _save(self, cache):
+        if self._path is None:
+            return
+        dirname = os.path.dirname(self._path)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".form-")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(cache, fp, ensure_ascii=False)
+            os.replace(tmppath, self._path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+
+
+    def get(self, fingerprint):
+        form = self._load().get("forms", {}).get(fingerprint)
+        if form is None:
+            return None
+        return form["fieldmap"]
+
+
+
+    def diff(self, description):
+        """Diff between the last validated form and this one."""
+        cache = self._load()
+        last = cache.get("forms", {}).get(cache.get("last"))
+        if last is None:
+            return None
+        return "\n".join(difflib.unified_diff(last["description"], description, "validated", "current", lineterm=""))
+
+
+
+    def put(self, fingerprint, description, fieldmap):
+        cache = self._load()
+        forms = cache.setdefault("forms", {})
+        known = forms.get(fingerprint)
+        if known is not None:
+            # Merge the parts of the form visited with other answers
+            known["fieldmap"]["fields"].update(fieldmap["fields"])
+            known["fieldmap"]["children"].update(fieldmap["children"])
+            fieldmap = known["fieldmap"]
+
+        forms[fingerprint] = {"description": description, "fieldmap": fieldmap, "seen": time.time()}
+        cache["last"] = fingerprint
+
+        for fp in sorted(forms, key=lambda fp: forms[fp]["seen"])[:-self.maxforms]:
+            del forms[fp]
+
+        self._save(cache)
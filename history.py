@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""Append-only history of the situation of an account.
+
+The situations are flattened into {path: value} maps, the path joining the
+keys and list indices with "/". Each snapshot is stored as the changes from
+the previous one, except for a keyframe holding the whole snapshot every
+few records. Every record is a gzip member appended to the history file, so
+that a crash can at worst lose the record being written.
+
+A small index file records the offset of each keyframe, so that the
+situation at any date is rebuilt by decompressing at most one keyframe and
+the deltas following it."""
+
+import argparse
+import bisect
+import datetime
+import fcntl
+import gzip
+import json
+import logging
+import os
+import sys
+import tempfile
+import zlib
+
+
+
+def flatten(obj, prefix=""):
+    """Flatten nested dicts and lists into a {path: value} dict."""
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return {prefix: obj}
+
+    flat = {}
+    for k, v in items:
+        path = "%s/%s" % (prefix, k) if prefix else str(k)
+        if isinstance(v, (dict, list)) and v:
+            flat.update(flatten(v, path))
+        else:
+            flat[path] = v
+    return flat
+
+
+
+def changes(old, new):
+    """Return the sorted list of (path, old value, new value) that differ
+    between two flat snapshots. A missing value is None."""
+    paths = set(old) | set(new)
+    return sorted((p, old.get(p), new.get(p)) for p in paths
+                  if p not in old or p not in new or old[p] != new[p])
+
+
+
+def formatchanges(diff):
+    lines = []
+    for path, old, new in diff:
+        old = "(absent)" if old is None else json.dumps(old, ensure_ascii=False)
+        new = "(absent)" if new is None else json.dumps(new, ensure_ascii=False)
+        lines.append("%s: %s -> %s" % (path, old, new))
+    return "\n".join(lines)
+
+
+
+class SituationHistory(object):
+    # Number of delta records between two keyframes
+    keyframe_interval = 32
+
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        self._indexpath = self._path + ".idx"
+
+
+
+    def _loadindex(self):
+        try:
+            with open(self._indexpath) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable history index %s: %s", self._indexpath, e)
+        # Without index, replay everything and write a keyframe next time
+        return {"keyframes": [], "count": self.keyframe_interval}
+
+
+
+    def _saveindex(self, index):
+        dirname = os.path.dirname(self._path)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".history-")
+        try:
+            with os.fdopen(fd, "w") as fp:
+                json.dump(index, fp)
+            os.replace(tmppath, self._indexpath)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+
+
+    def _records(self, offset=0):
+        """Yield the records from offset along with the offset following
+        each of them. Stop at the first incomplete or corrupt record."""
+        try:
+            with open(self._path, "rb") as fp:
+                fp.seek(offset)
+                data = memoryview(fp.read())
+        except FileNotFoundError:
+            return
+
+        pos = 0
+        while pos < len(data):
+            member = zlib.decompressobj(wbits=31)
+            try:
+                line = member.decompress(data[pos:])
+                if not member.eof:
+                    raise EOFError("truncated record")
+                rec = json.loads(line)
+            except (EOFError, zlib.error, ValueError) as e:
+                logging.warning("Ignoring the end of %s from offset %d: %s", self._path, offset + pos, e)
+                return
+
+            pos = len(data) - len(member.unused_data)
+            yield rec, offset + pos
+
+
+
+    def _replay(self, offset=0, until=None):
+        """Rebuild the snapshot at time until (an ISO string), starting at
+        the keyframe at offset. Return the snapshot, its time and the offset
+        following its last record."""
+        state = {}
+        last = None
+        end = offset
+
+        for rec, recend in self._records(offset):
+            if until is not None and rec["t"] > until:
+                break
+            if "key" in rec:
+                state = rec["key"]
+            else:
+                state.update(rec["set"])
+                for p in rec["del"]:
+                    state.pop(p, None)
+            last = rec["t"]
+            end = recend
+
+        return state, last, end
+
+
+
+    def at(self, when):
+        """Return the flat snapshot at time when (datetime or ISO string)
+        along with its time, or ({}, None) if there's none."""
+        if isinstance(when, datetime.datetime):
+            when = when.isoformat(timespec="seconds")
+
+        keyframes = self._loadindex()["keyframes"]
+        i = bisect.bisect_right([t for t, _ in keyframes], when)
+        offset = keyframes[i - 1][1] if i > 0 else 0
+        state, last, _ = self._replay(offset, when)
+        return state, last
+
+
+
+    def diff(self, since, until=None):
+        """Return the changes between the snapshots at two times."""
+        if until is None:
+            until = "9999"
+        old, _ = self.at(since)
+        new, _ = self.at(until)
+        return changes(old, new)
+
+
+
+    def append(self, situation, when=None):
+        """Record a snapshot of the situation if it changed. Return the
+        changes from the previous snapshot and the time of that snapshot."""
+        if when is None:
+            when = datetime.datetime.now()
+        when = when.isoformat(timespec="seconds")
+        new = flatten(situation)
+
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, "ab") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+
+            index = self._loadindex()
+            keyframes = index["keyframes"]
+            size = fp.seek(0, os.SEEK_END)
+            while True:
+                if keyframes and keyframes[-1][1] >= size:
+                    # Keyframe lost with the end of the file, write a new one
+                    keyframes.pop()
+                    index["count"] = self.keyframe_interval
+                    continue
+
+                old, last, end = self._replay(keyframes[-1][1] if keyframes else 0)
+                if end == size:
+                    break
+
+                # Left by a crash, the records appended after it would be
+                # unreadable
+                logging.warning("Truncating %s to its last complete record at offset %d", self._path, end)
+                os.ftruncate(fp.fileno(), end)
+                size = end
+
+            diff = changes(old, new)
+            if last is not None and not diff:
+                logging.debug("Situation unchanged since %s", last)
+                return diff, last
+
+            if last is not None and when <= last:
+                # Keep the records sorted even if the clock went backward
+                when = last
+
+            offset = size
+            if index["count"] >= self.keyframe_interval:
+                rec = {"t": when, "key": new}
+                keyframes.append([when, offset])
+                index["count"] = 0
+            else:
+                rec = {"t": when, "set": {p: n for p, _, n in diff if p in new},
+                       "del": [p for p, _, _ in diff if p not in new]}
+                index["count"] += 1
+
+            fp.write(gzip.compress(json.dumps(rec, ensure_ascii=False).encode() + b"\n", mtime=0))
+            fp.flush()
+            self._saveindex(index)
+
+        logging.debug("Recorded situation with %d changes since %s", len(diff), last)
+        return diff, last
+
+
+
+    def record(self, situation):
+        """Same as append, but only log the errors and return None, keeping
+        the history must never prevent using the situation."""
+        try:
+            return self.append(situation)
+        except Exception:
+            logging.exception("Could not record the situation in %s", self._path)
+            return None
+
+
+
+def _parsetime(value, end):
+    """Parse AAAA-MM-JJ[THH:MM[:SS]], a date alone meaning its start or its
+    end."""
+    if len(value) == 10:
+        value += "T23:59:59" if end else "T00:00:00"
+    return datetime.datetime.fromisoformat(value)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Affiche les changements de situation enregistrés entre deux dates")
+    parser.add_argument("history", help="Fichier d'historique (situation-history.gz dans le répertoire d'état du compte)")
+    parser.add_argument("--since", metavar="AAAA-MM-JJ", required=True, help="Date de la situation de départ")
+    parser.add_argument("--until", metavar="AAAA-MM-JJ", help="Date de la situation d'arrivée, par défaut la dernière")
+
+    args = parser.parse_args()
+
+    hist = SituationHistory(args.history)
+    until = _parsetime(args.until, True) if args.until else None
+    diff = hist.diff(_parsetime(args.since, True), until)
+    if diff:
+        print(formatchanges(diff))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
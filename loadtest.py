@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""Load scenarios run against mockserver.py to measure the throughput and
+tail latency of the client with many accounts and courriers."""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import logging
+import math
+import sys
+import threading
+import time
+
+import autovalidate
+import mockserver
+import paul
+import ratelimit
+import transport
+
+
+
+class Timings(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._times = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def record(self, op, seconds):
+        with self._lock:
+            self._times[op].append(seconds)
+
+    def error(self, op):
+        with self._lock:
+            self.errors[op] += 1
+
+    def timed(self, op, func, *args):
+        t = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception:
+            self.error(op)
+            raise
+        finally:
+            self.record(op, time.perf_counter() - t)
+
+    def items(self):
+        return sorted(self._times.items())
+
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return float("nan")
+    k = math.ceil(p / 100 * len(values)) - 1
+    return values[max(0, k)]
+
+
+
+def scenario_status(pe, timings):
+    timings.timed("situation", pe.getSituationsUtilisateur)
+    timings.timed("unread", pe.count_unread)
+
+
+
+def scenario_mails(pe, timings):
+    mails = timings.timed("listing", pe.newmails, True, "01/01/1970")
+    for m in mails:
+        timings.timed("download", pe.download_mail, m['link'])
+
+
+
+def scenario_actualise(pe, timings):
+    answers = autovalidate.make_answers(datetime.datetime.now())
+    timings.timed("actualisation", pe.actualisation, answers)
+
+
+
+SCENARIOS = {
+    "login": lambda pe, timings: None,
+    "status": scenario_status,
+    "mails": scenario_mails,
+    "actualise": scenario_actualise,
+}
+
+
+
+def run_account(baseurl, username, password, scenario, timings):
+    pe = timings.timed("login", paul.PaulEmploi, username, password, baseurl)
+    SCENARIOS[scenario](pe, timings)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tests de charge contre le faux site France Travail")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS), help="Scénario à exécuter pour chaque compte")
+    parser.add_argument("--accounts", "-a", type=int, default=100, help="Nombre de comptes")
+    parser.add_argument("--mails", "-m", type=int, default=20, help="Nombre de courriers par compte")
+    parser.add_argument("--page-size", type=int, default=10, help="Nombre de courriers par page")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence ajoutée par le serveur (secondes)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latence aléatoire supplémentaire maximale (secondes)")
+    parser.add_argument("--concurrency", "-c", type=int, default=8, help="Nombre de comptes traités en parallèle")
+    parser.add_argument("--rate", metavar="REQ/S[/RAFALE]", default="0", help="Limite de requêtes par seconde par hôte, 0 pour aucune limite")
+    parser.add_argument("--url", help="URL d'un mockserver.py déjà lancé plutôt qu'un serveur local")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    state = None
+    baseurl = args.url
+    if baseurl is None:
+        state = mockserver.MockState(args.accounts, args.mails, args.page_size, args.latency, args.jitter)
+        baseurl = mockserver.MockServer(state).start()
+
+    limiter = ratelimit.configure(ratelimit.parserate(args.rate))
+    transport.configure(poolsize=args.concurrency)
+    timings = Timings()
+    failed = 0
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        futures = []
+        for i in range(args.accounts):
+            futures.append(pool.submit(run_account, baseurl, "user%04d" % i, "pwd%04d" % i, args.scenario, timings))
+
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                failed += 1
+                logging.warning("Account failed: %r", e)
+
+    elapsed = time.perf_counter() - start
+
+    print("Scenario %s: %d accounts, concurrency %d, %.2fs, %d failed" % (args.scenario, args.accounts, args.concurrency, elapsed, failed))
+    if state is not None:
+        print("HTTP requests: %d (%.1f req/s)" % (state.requests, state.requests / elapsed))
+
+    print("%-14s %7s %9s %9s %9s %9s %9s %7s" % ("operation", "count", "ops/s", "p50 ms", "p95 ms", "p99 ms", "max ms", "errors"))
+    for op, times in timings.items():
+        times.sort()
+        print("%-14s %7d %9.1f %9.1f %9.1f %9.1f %9.1f %7d" % (
+            op, len(times), len(times) / elapsed,
+            percentile(times, 50) * 1000, percentile(times, 95) * 1000,
+            percentile(times, 99) * 1000, times[-1] * 1000, timings.errors[op]))
+
+    print()
+    print(limiter.summary(), end="")
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
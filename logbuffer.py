@@ -0,0 +1,162 @@
+import collections
+import contextlib
+import gzip
+import heapq
+import logging
+import sys
+import threading
+
+
+
+class RingBufferHandler(logging.Handler):
+    """Keep the most recent log records in memory, up to capacity bytes per
+    account. The records whose arguments are only strings and numbers are
+    formatted when the logs are retrieved, that is, when an error mail is
+    actually sent. The others are formatted when they're logged."""
+
+    def __init__(self, capacity=1048576, level=logging.NOTSET):
+        super(RingBufferHandler, self).__init__(level)
+        self.capacity = capacity
+        self._buffers = {}
+        self._default = None
+        self._local = threading.local()
+
+
+
+    def select(self, account):
+        """Set the account the records are stored for, for all threads that
+        didn't select one with the account() context manager."""
+        self._default = account
+
+
+
+    @contextlib.contextmanager
+    def account(self, account):
+        """Store the records of the current thread for this account."""
+        prev = getattr(self._local, "account", None)
+        self._local.account = account
+        try:
+            yield self
+        finally:
+            self._local.account = prev
+
+
+
+    def _current(self):
+        account = getattr(self._local, "account", None)
+        if account is None:
+            account = self._default
+        return account
+
+
+
+    # Arguments kept as is, formatting them later gives the same result and
+    # their size is known
+    _LAZYTYPES = (str, int, float)
+
+    @classmethod
+    def _lazy(cls, record):
+        """Whether the message can be formatted later."""
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        return isinstance(record.msg, str) and all(isinstance(a, cls._LAZYTYPES) for a in args or ())
+
+
+
+    # Record attributes referencing strings shared with the code objects,
+    # the loggers or the threads
+    _SHARED = frozenset(["name", "levelname", "pathname", "filename", "module",
+                         "funcName", "threadName", "processName", "taskName"])
+
+    @classmethod
+    def _recordsize(cls, record):
+        # Memory used by the record, its attribute dict and the attributes
+        # it owns. The args are only strings and numbers at this point.
+        size = sys.getsizeof(record) + sys.getsizeof(record.__dict__)
+        size += sum(sys.getsizeof(v) for k, v in record.__dict__.items() if k not in cls._SHARED)
+        args = record.args
+        if isinstance(args, dict):
+            args = args.values()
+        size += sum(sys.getsizeof(a) for a in args or ())
+        return size
+
+
+
+    def emit(self, record):
+        lazy = self._lazy(record)
+        if record.exc_info or not lazy:
+            record = logging.makeLogRecord(record.__dict__)
+
+        if not lazy:
+            # Other objects are rendered now, with their current state, and
+            # not kept alive with whatever they reference
+            try:
+                record.msg = record.getMessage()
+            except Exception:
+                self.handleError(record)
+                return
+            record.args = None
+
+        if record.exc_info:
+            # Don't keep the frames alive until the end of the run
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        key = self._current()
+        buf = self._buffers.get(key)
+        if buf is None:
+            # Records, total size, number of records dropped
+            buf = self._buffers[key] = [collections.deque(), 0, 0]
+
+        records = buf[0]
+        size = self._recordsize(record)
+        records.append((size, record))
+        buf[1] += size
+
+        while buf[1] > self.capacity and len(records) > 1:
+            oldsize, _ = records.popleft()
+            buf[1] -= oldsize
+            buf[2] += 1
+
+
+
+    def getvalue(self, account=None):
+        """Format the records common to all accounts and those of the given
+        account (or the current one) sorted by time."""
+        if account is None:
+            account = self._current()
+
+        keys = [None] if account is None else [None, account]
+        self.acquire()
+        try:
+            bufs = [self._buffers[k] for k in keys if k in self._buffers]
+            dropped = sum(b[2] for b in bufs)
+            streams = [list(b[0]) for b in bufs]
+        finally:
+            self.release()
+
+        lines = []
+        if dropped:
+            lines.append("[%d older records dropped]" % dropped)
+
+        merged = heapq.merge(*streams, key=lambda sr: sr[1].created)
+        for _, record in merged:
+            lines.append(self.format(record))
+
+        return "\n".join(lines) + "\n"
+
+
+
+    def gzipped(self, account=None):
+        return gzip.compress(self.getvalue(account).encode())
+
+
+
+    def clear(self, account=None):
+        self.acquire()
+        try:
+            self._buffers.pop(account, None)
+        finally:
+            self.release()
@@ -1,24 +1,33 @@
 import logging
-import colorama
+import sys
 
 
 
 class ColorLogFormatter(logging.Formatter):
     namecolors = {
-        'DEBUG': colorama.Fore.BLUE,
-        'INFO': colorama.Fore.GREEN,
-        'WARNING': colorama.Fore.YELLOW,
-        'ERROR': colorama.Style.DIM + colorama.Fore.RED,
-        'CRITICAL': colorama.Fore.RED
+        'DEBUG': lambda c: c.Fore.BLUE,
+        'INFO': lambda c: c.Fore.GREEN,
+        'WARNING': lambda c: c.Fore.YELLOW,
+        'ERROR': lambda c: c.Style.DIM + c.Fore.RED,
+        'CRITICAL': lambda c: c.Fore.RED
     }
 
     def __init__(self, *args, **kwargs):
         super(ColorLogFormatter, self).__init__(*args, **kwargs)
-        colorama.init()
+
+        # The console handler logs to stderr, only load colorama for a TTY
+        self._colorama = None
+        if sys.stderr.isatty():
+            import colorama
+            colorama.init()
+            self._colorama = colorama
 
     def colorname(self, name):
-        s = self.namecolors.get(name, "")
-        return colorama.Style.BRIGHT + s + name + colorama.Style.RESET_ALL
+        c = self._colorama
+        if c is None:
+            return name
+        s = self.namecolors.get(name, lambda c: "")(c)
+        return c.Style.BRIGHT + s + name + c.Style.RESET_ALL
 
     def format(self, record):
         record.levelnamecolor = self.colorname(record.levelname)
@@ -1,14 +1,74 @@
-import email.message
-import email.policy
+import json
 import logging
-import mimetypes
-import smtplib
-import subprocess
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
 
+import profiling
 
+# The email, mailbox and smtplib modules are only imported when a message is
+# sent.
+
+
+
+class Backend(object):
+    """Deliver email.message.EmailMessage objects somewhere.
+
+    Backends may keep resources open (connection, lock) between messages.
+    They are kept open as long as the backend is used as a context manager,
+    and released after each message otherwise."""
+
+    # Name of the profiling phase of the deliveries
+    phasename = "deliver"
+    # Line separator of the messages, local mailboxes use the Unix one
+    linesep = "\n"
+
+    def __init__(self):
+        self._keepopen = 0
+
+
+
+    def __enter__(self):
+        self._keepopen += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._keepopen -= 1
+        if self._keepopen == 0:
+            self.close()
+
+
+
+    def deliver(self, mail):
+        with self, profiling.phase(self.phasename):
+            self._deliver(mail)
+
+    def deliver_many(self, mails):
+        with self:
+            for mail in mails:
+                with profiling.phase(self.phasename):
+                    self._deliver(mail)
+
+
+
+    def _deliver(self, mail):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+
+class SMTPBackend(Backend):
+    phasename = "smtp send"
+    linesep = "\r\n"
 
-class Mailer(object):
     def __init__(self, host, port=None, authmethod=None, user=None, pwd=None, oauthcmd=None):
+        super(SMTPBackend, self).__init__()
+
         if authmethod is None:
             if pwd and oauthcmd:
                 raise ValueError("SMTP password and oauthcmd provided")
@@ -20,15 +80,17 @@ class Mailer(object):
 
         self._host = host
         self._port = port
-        self._auth = authmethod
+        self._auth = authmethod.lower() if authmethod else authmethod
         self._user = user
         self._pass = pwd
-        self._oauthcmd = oauthcmd.lower()
-
+        self._oauthcmd = oauthcmd
+        self._smtp = None
 
 
 
     def _oauthcb(self, x=None):
+        import subprocess
+
         if x is not None:
             return ""
         logging.debug("Running OAuth token generation command: %s", self._oauthcmd)
@@ -40,15 +102,303 @@ class Mailer(object):
 
 
 
-    def message(self, to, subj, msg, attachments=None):
+    def _connect(self):
+        import smtplib
+
+        if self._smtp is not None:
+            return self._smtp
+
+        logging.debug("Connecting to SMTP server %s:%r", self._host, self._port)
+        smtp = smtplib.SMTP_SSL(self._host, port=self._port)
+
+        if not self._auth:
+            logging.info("No SMTP authentication method provided")
+        elif self._auth == "login":
+            logging.debug("Login to SMTP server with username: %s", self._user)
+            smtp.login(self._user, self._pass)
+        elif self._auth == "oauth":
+            logging.debug("OAuth to SMTP server with username: %s", self._user)
+            smtp.ehlo_or_helo_if_needed()
+            smtp.auth("XOAUTH2", self._oauthcb)
+        else:
+            raise ValueError("Unknown SMTP authentication method " + self._auth)
+
+        self._smtp = smtp
+        return smtp
+
+
+
+    def _deliver(self, mail):
+        import smtplib
+
+        logging.debug("Sending message of %d bytes", len(mail.as_bytes()))
+        try:
+            self._connect().send_message(mail)
+        except smtplib.SMTPServerDisconnected:
+            # The server may close a connection kept open between tasks
+            logging.debug("SMTP server disconnected, reconnecting")
+            self._smtp = None
+            self._connect().send_message(mail)
+
+
+
+    def close(self):
+        import smtplib
+
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+
+        try:
+            smtp.quit()
+        except smtplib.SMTPException:
+            smtp.close()
+
+
+
+class MaildirBackend(Backend):
+    """Deliver to a Maildir. Messages are written in tmp/ and then moved to
+    new/ so readers never see a partial message."""
+
+    def __init__(self, path):
+        super(MaildirBackend, self).__init__()
+        self._path = os.path.expanduser(path)
+        self._maildir = None
+
+
+
+    def _deliver(self, mail):
+        import mailbox
+
+        if self._maildir is None:
+            dirname = os.path.dirname(self._path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._maildir = mailbox.Maildir(self._path, create=True)
+
+        key = self._maildir.add(mail)
+        logging.debug("Delivered message %s to Maildir %s", key, self._path)
+
+
+
+    def close(self):
+        self._maildir = None
+
+
+
+class MboxBackend(Backend):
+    """Append to a mbox file. The mbox stays locked while the backend is kept
+    open and is flushed once for a whole batch."""
+
+    def __init__(self, path):
+        super(MboxBackend, self).__init__()
+        self._path = os.path.expanduser(path)
+        self._mbox = None
+
+
+
+    def _deliver(self, mail):
+        import mailbox
+
+        if self._mbox is None:
+            dirname = os.path.dirname(self._path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            mbox = mailbox.mbox(self._path, create=True)
+            mbox.lock()
+            self._mbox = mbox
+
+        self._mbox.add(mail)
+        logging.debug("Appended message to mbox %s", self._path)
+
+
+
+    def close(self):
+        mbox, self._mbox = self._mbox, None
+        if mbox is None:
+            return
+
+        try:
+            mbox.flush()
+        finally:
+            mbox.unlock()
+            mbox.close()
+
+
+
+class DirectoryBackend(Backend):
+    """Store each message in its own directory containing the attachments
+    and a metadata.json file. The directory is filled under a temporary name
+    and renamed once complete."""
+
+    def __init__(self, path):
+        super(DirectoryBackend, self).__init__()
+        self._path = os.path.expanduser(path)
+
+
+
+    @staticmethod
+    def _safename(name):
+        name = re.sub(r'[^\w.-]+', "_", name).strip("._")
+        return name[:80] or "message"
+
+
+
+    def _deliver(self, mail):
+        os.makedirs(self._path, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=self._path, prefix=".tmp-")
+
+        try:
+            attachments = []
+            for part in mail.iter_attachments():
+                name = self._safename(part.get_filename() or "attachment")
+                with open(os.path.join(tmpdir, name), "wb") as fp:
+                    fp.write(part.get_payload(decode=True))
+                attachments.append(name)
+
+            body = mail.get_body(preferencelist=('plain',))
+            metadata = {
+                "subject": mail['Subject'],
+                "from": mail['From'],
+                "to": mail['To'],
+                "date": mail['Date'],
+                "message-id": mail['Message-ID'],
+                "text": body.get_content() if body is not None else "",
+                "attachments": attachments,
+            }
+
+            with open(os.path.join(tmpdir, "metadata.json"), "w") as fp:
+                json.dump(metadata, fp, indent=4, ensure_ascii=False)
+
+            subject = re.sub(r'^\[.*?\]\s*', "", mail['Subject'])
+            basename = time.strftime("%Y%m%d-%H%M%S-") + self._safename(subject)
+            dest = os.path.join(self._path, basename)
+            n = 1
+            while os.path.exists(dest):
+                n += 1
+                dest = os.path.join(self._path, "%s-%d" % (basename, n))
+
+            os.rename(tmpdir, dest)
+        except BaseException:
+            for name in os.listdir(tmpdir):
+                os.unlink(os.path.join(tmpdir, name))
+            os.rmdir(tmpdir)
+            raise
+
+        logging.debug("Stored message in %s", dest)
+
+
+
+BACKENDS = {
+    "maildir": MaildirBackend,
+    "mbox": MboxBackend,
+    "directory": DirectoryBackend,
+}
+
+
+
+class Mailer(object):
+    def __init__(self, backend, sender):
+        self._backend = backend
+        self._user = sender
+        self._queue = None
+        self._thread = None
+        self._results = []
+
+
+
+    def __enter__(self):
+        # Keep the backend open (SMTP connection, mbox lock) until __exit__
+        self._backend.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._backend.__exit__(*exc)
+
+
+
+    def start(self, queuesize=4):
+        """Run the jobs given to submit() in a background thread, so that
+        the messages are delivered while the next ones are downloaded."""
+        self._queue = queue.Queue(queuesize)
+        self._results = []
+        self._thread = threading.Thread(target=self._sender, name="mailer", daemon=True)
+        self._thread.start()
+
+
+
+    def _sender(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            name, func, args = job
+            try:
+                res = func(*args)
+            except BaseException as e:
+                logging.exception("Background delivery of %r failed", name)
+                self._results.append((name, None, e))
+            else:
+                self._results.append((name, res, None))
+
+
+
+    def submit(self, name, func, *args):
+        """Call func(*args) in the sender thread, or right away if it's not
+        started. Block while the queue is full."""
+        if self._thread is None:
+            return func(*args)
+
+        if not self._thread.is_alive():
+            raise RuntimeError("Mailer thread is not running")
+
+        self._queue.put((name, func, args))
+
+
+
+    def join(self, reraise=True):
+        """Wait for the submitted jobs and stop the sender thread. Return the
+        list of (name, result, exception) of every job. Raise the first
+        exception unless reraise is False."""
+        if self._thread is None:
+            return []
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+
+        results, self._results = self._results, []
+        failed = [e for _, _, e in results if e is not None]
+        for name, res, e in results:
+            logging.debug("Background job %r: %s", name, "failed: %r" % e if e is not None else res)
+        logging.info("%d background jobs done, %d failed", len(results), len(failed))
+
+        if failed and reraise:
+            raise failed[0]
+
+        return results
+
+
+
+    @profiling.profiled("mime build")
+    def build(self, to, subj, msg, attachments=None):
+        import email.message
+        import email.policy
+        import email.utils
+        import mimetypes
+
         if attachments is None:
             attachments = []
 
-        policy = email.policy.EmailPolicy(raise_on_defect=True, linesep="\r\n", utf8=True)
+        policy = email.policy.EmailPolicy(raise_on_defect=True, linesep=self._backend.linesep, utf8=True)
         mail = email.message.EmailMessage(policy=policy)
         mail['Subject'] = "[BOT Paul Emploi] %s" % subj
         mail['From'] = "Bot Paul-Emploi <%s>" % self._user
         mail['To'] = "Chômeur <%s>" % to
+        mail['Date'] = email.utils.formatdate(localtime=True)
+        mail['Message-ID'] = email.utils.make_msgid("paulemploi")
         mail.set_content(msg, disposition='inline')
 
         for name, content in attachments:
@@ -59,24 +409,18 @@ class Mailer(object):
             maintype, subtype = mime.split("/")
             mail.add_attachment(content, maintype=maintype, subtype=subtype, filename=name)
 
-        logging.debug("Connecting to SMTP server %s:%r", self._host, self._port)
-        smtp = smtplib.SMTP_SSL(self._host, port=self._port)
+        return mail
 
-        if not self._auth:
-            logging.info("No SMTP authentication method provided")
-        elif self._auth == "login":
-            logging.debug("Login to SMTP server with username: %s", self._user)
-            smtp.login(self._user, self._pass)
-        elif self._auth == "oauth":
-            logging.debug("OAuth to SMTP server with username: %s", self._user)
-            smtp.ehlo_or_helo_if_needed()
-            smtp.auth("XOAUTH2", self._oauthcb)
-        else:
-            raise ValueError("Unknown SMTP authentication method " + self._auth)
 
-        logging.debug("Sending message of %d bytes", len(mail.as_bytes()))
-        smtp.send_message(mail)
-        smtp.quit()
+
+    def message(self, to, subj, msg, attachments=None):
+        self._backend.deliver(self.build(to, subj, msg, attachments))
+
+
+
+    def messages(self, msgs):
+        """Deliver a batch of (to, subj, msg, attachments) tuples."""
+        self._backend.deliver_many(self.build(*m) for m in msgs)
 
 
 
@@ -0,0 +1,607 @@
+#!/usr/bin/env python3
+
+"""Local stand-in for the France Travail site.
+
+It reproduces the pages and JSON APIs paul.py uses: the espacepersonnel page
+and its main.js, the OpenAM login, the navigation and situation APIs, the
+paginated list of courriers, their PDF and the actualisation form. It's meant
+for load testing, never point it at real credentials."""
+
+import argparse
+import datetime
+import html
+import http.cookies
+import http.server
+import json
+import logging
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+
+
+
+def make_pdf(lines):
+    """Build a small one-page PDF showing the given lines of text."""
+    def pdfstr(s):
+        s = s.encode("latin-1", "replace")
+        return b"(" + s.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+    content = b"BT /F1 12 Tf 72 770 Td 14 TL\n"
+    for line in lines:
+        content += pdfstr(line) + b" Tj T*\n"
+    content += b"ET\n"
+    stream = zlib.compress(content)
+
+    objs = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objs, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1)
+    for off in offsets:
+        pdf += b"%010d 00000 n \n" % off
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objs) + 1, xref)
+    return pdf
+
+
+
+def jsobject(obj):
+    """Serialize obj the way main.js does: JSON with unquoted keys."""
+    return re.sub(r'"([a-zA-Z0-9_]+)":', r'\1:', json.dumps(obj))
+
+
+
+MAILTITLES = [
+    "Avis de situation",
+    "Avis de paiement",
+    "Attestation employeur",
+    "Convocation à un entretien",
+    "Notification de droits",
+    "Relevé de situation",
+]
+
+QUESTIONS = [
+    ("travailleBloc", "Avez-vous travaillé ou exercé une activité non salariée ?", "travail"),
+    ("stageBloc", "Avez-vous été en stage ?", None),
+    ("maladieBloc", "Avez-vous été en arrêt maladie ?", None),
+    ("materniteBloc", "Avez-vous été en congé maternité ?", None),
+    ("retraiteBloc", "Percevez-vous une nouvelle pension retraite ?", None),
+    ("invaliditeBloc", "Percevez-vous une nouvelle pensiond'invalidité de 2ème ou 3ème catégorie ?", None),
+    ("rechercheBloc", "Etes-vous toujours à la recherche d'un emploi ?", None),
+]
+
+SUBQUESTIONS = [
+    ("nbHeuresTravBloc", "Heures travaillées dans le mois", "nbHeuresTrav"),
+    ("montSalaireBloc", "Montant total de votre ou vos salaires bruts réels ou estimés", "montSalaire"),
+]
+
+
+
+class MockAccount(object):
+    def __init__(self, username, password, nmails, rng):
+        self.username = username
+        self.password = password
+        self.declared = None
+        self.mails = []
+
+        today = datetime.date.today()
+        for i in range(nmails):
+            self.mails.append({
+                "id": "%s-%d" % (username, i),
+                "date": today - datetime.timedelta(days=rng.randrange(0, 365)),
+                "title": rng.choice(MAILTITLES),
+                "channel": rng.choice(["Web", "Papier"]),
+                "read": rng.random() < 0.5,
+            })
+        self.mails.sort(key=lambda m: m["date"], reverse=True)
+
+
+
+class MockState(object):
+    def __init__(self, naccounts=1, nmails=20, pagesize=10, latency=0.0, jitter=0.0, seed=0):
+        rng = random.Random(seed)
+        self.pagesize = pagesize
+        self.latency = latency
+        self.jitter = jitter
+        self.baseurl = None
+        self.lock = threading.Lock()
+        self.requests = 0
+
+        self.accounts = {}
+        for i in range(naccounts):
+            acc = MockAccount("user%04d" % i, "pwd%04d" % i, nmails, rng)
+            self.accounts[acc.username] = acc
+
+        self.mailsbyid = {m["id"]: (acc, m) for acc in self.accounts.values() for m in acc.mails}
+        self.auths = {}     # authId -> {"stage":..., "user":...}
+        self.tokens = {}    # tokenId cookie -> account
+        self.access = {}    # bearer token -> account
+
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    cookiename = "idmock"
+
+    def log_message(self, fmt, *args):
+        logging.debug("mockserver: " + fmt, *args)
+
+
+
+    @property
+    def state(self):
+        return self.server.state
+
+
+
+    def _send(self, body, ctype="text/html; charset=utf-8", status=200, headers=()):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, obj, status=200):
+        self._send(json.dumps(obj), "application/json", status)
+
+    def _redirect(self, location):
+        self._send("", status=302, headers=[("Location", location)])
+
+    def _page(self, body):
+        self._send("<!DOCTYPE html><html><head><meta charset='utf-8'><title>Mock</title></head><body>%s</body></html>" % body)
+
+    def _error(self, status, msg=""):
+        self._send(msg, "text/plain", status)
+
+
+
+    def _account_cookie(self):
+        cookies = http.cookies.SimpleCookie(self.headers.get("Cookie", ""))
+        if self.cookiename not in cookies:
+            return None
+        return self.state.tokens.get(cookies[self.cookiename].value)
+
+    def _account_bearer(self):
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Bearer "):
+            return None
+        return self.state.access.get(auth[len("Bearer "):])
+
+
+
+    def _form(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body) if body else None
+        return dict(urllib.parse.parse_qsl(body, keep_blank_values=True))
+
+
+
+    def _handle(self, method):
+        st = self.state
+        with st.lock:
+            st.requests += 1
+
+        if st.latency or st.jitter:
+            time.sleep(st.latency + random.random() * st.jitter)
+
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        route = ROUTES.get((method, url.path))
+        if route is None:
+            for (m, prefix), func in PREFIXROUTES.items():
+                if m == method and url.path.startswith(prefix):
+                    route = func
+                    break
+
+        if route is None:
+            self._error(404, "No route for %s %s" % (method, url.path))
+            return
+
+        route(self, url, query)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+
+
+    # Espace personnel and main.js
+
+    def espacepersonnel(self, url, query):
+        self._page('<div id="app"></div><script src="/espacepersonnel/main.0123abcd.js"></script>')
+
+    def mainjs(self, url, query):
+        base = self.state.baseurl
+        peam = [{
+            "id": "individu",
+            "openAMUrl": base + "/connexion",
+            "redirectUri": base + "/espacepersonnel/",
+            "commonRessource": {"realm": "/individu", "clientId": "MOCK_CLIENT"},
+            "authorizeResource": {"url": "/oauth2/authorize", "scope": "openid profile", "responseType": "id_token token"},
+        }]
+        rest = {
+            "ex002": {"situationsUtilisateur": base + "/api/situations"},
+            "ex009": {"uri": base + "/api/courriers", "courriersNombre": "/nombre"},
+            "ex017": {"uri": base + "/api/navigation", "navigation": "/menu"},
+        }
+        js = "!function(){var e={production:!0,openAMConfig:%s,rest:%s,layout:{}};window.cfg=e}();" % (jsobject(peam), jsobject(rest))
+        self._send(js, "application/javascript")
+
+
+
+    # OpenAM
+
+    def authorize(self, url, query):
+        st = self.state
+        account = self._account_cookie()
+        if account is None:
+            goto = urllib.parse.quote(st.baseurl + self.path, safe="")
+            self._redirect("/connexion/XUI/?realm=%s&goto=%s#login/" % (query.get("realm", "/individu"), goto))
+            return
+
+        token = secrets.token_hex(16)
+        with st.lock:
+            st.access[token] = account
+        fragment = urllib.parse.urlencode({"access_token": token, "state": query.get("state", ""), "token_type": "Bearer"})
+        self._redirect(query.get("redirect_uri", "/espacepersonnel/") + "#" + fragment)
+
+    def xui(self, url, query):
+        self._page("<div id='login'>Connexion</div>")
+
+    def serverinfo(self, url, query):
+        self._json({"cookieName": self.cookiename, "domains": [urllib.parse.urlsplit(self.state.baseurl).hostname], "secureCookie": False})
+
+    def authenticate(self, url, query):
+        st = self.state
+        form = self._form()
+
+        if not form:
+            authid = secrets.token_hex(8)
+            with st.lock:
+                st.auths[authid] = {"stage": 1, "goto": query.get("goto")}
+            self._json({"authId": authid, "callbacks": [
+                {"type": "NameCallback", "output": [{"name": "prompt", "value": "Identifiant"}], "input": [{"name": "IDToken1", "value": ""}]},
+            ]})
+            return
+
+        auth = st.auths.get(form.get("authId"))
+        if auth is None:
+            self._json({"code": 401, "reason": "Unauthorized"}, 401)
+            return
+
+        if auth["stage"] == 1:
+            auth["user"] = form["callbacks"][0]["input"][0]["value"]
+            auth["stage"] = 2
+            self._json({"authId": form["authId"], "callbacks": [
+                {"type": "NameCallback", "output": [], "input": [{"name": "IDToken1", "value": auth["user"]}]},
+                {"type": "PasswordCallback", "output": [{"name": "prompt", "value": "Mot de passe"}], "input": [{"name": "IDToken2", "value": ""}]},
+            ]})
+        elif auth["stage"] == 2:
+            account = st.accounts.get(auth["user"])
+            if account is None or form["callbacks"][1]["input"][0]["value"] != account.password:
+                self._json({"code": 401, "reason": "Unauthorized", "message": "Authentication Failed"}, 401)
+                return
+
+            auth["stage"] = 3
+            auth["account"] = account
+            self._json({"authId": form["authId"], "callbacks": [
+                {"type": "TextOutputCallback", "output": [{"name": "message", "value": "{}"}], "input": [{"name": "IDToken3", "value": ""}]},
+            ]})
+        else:
+            tokenid = secrets.token_hex(16)
+            with st.lock:
+                st.tokens[tokenid] = auth["account"]
+                del st.auths[form["authId"]]
+            successurl = auth["goto"] or st.baseurl + "/connexion/oauth2/authorize"
+            self._json({"tokenId": tokenid, "successUrl": successurl, "realm": "/individu"})
+
+
+
+    # JSON APIs
+
+    def _period(self):
+        return datetime.date.today().replace(day=1)
+
+    def situations(self, url, query):
+        account = self._account_bearer()
+        if account is None:
+            self._json({"message": "Unauthorized"}, 401)
+            return
+
+        period = self._period()
+        self._json({
+            "indemnisation": {
+                "typeAllocation": "ARE",
+                "indemnisationJournalierNet": "35.42",
+                "dateDecheanceDroitAre": (period + datetime.timedelta(days=400)).isoformat() + "T00:00:00",
+            },
+            "actualisation": {
+                "periodeCourante": {
+                    "reference": period.isoformat() + "T00:00:00",
+                    "dateFin": (period + datetime.timedelta(days=14)).isoformat() + "T23:59:59",
+                },
+            },
+        })
+
+    def navigation(self, url, query):
+        if self._account_bearer() is None:
+            self._json({"message": "Unauthorized"}, 401)
+            return
+
+        base = self.state.baseurl
+        self._json({"burger": [
+            {"code": "dossier-de", "url": None, "sousElements": [
+                {"code": "actualisation", "url": None, "sousElements": [
+                    {"code": "m-actualiser", "url": base + "/espacepersonnel/actualisation/start", "sousElements": []},
+                ]},
+            ]},
+            {"code": "contacts-documents", "url": None, "sousElements": [
+                {"code": "documents", "url": None, "sousElements": [
+                    {"code": "courriers-recus-pe", "url": base + "/espacepersonnel/courriers/", "sousElements": []},
+                ]},
+            ]},
+        ]})
+
+    def courriersnombre(self, url, query):
+        account = self._account_bearer()
+        if account is None:
+            self._json({"message": "Unauthorized"}, 401)
+            return
+        self._json({"total": sum(1 for m in account.mails if not m["read"])})
+
+
+
+    # Courriers
+
+    def courriers(self, url, query):
+        if self._account_cookie() is None:
+            self._error(403)
+            return
+        self._page('<form method="post" action="/espacepersonnel/courriers/init"><input type="hidden" name="init" value="1"></form>')
+
+    def courriersinit(self, url, query):
+        self._form()
+        self._page('<form method="post" action="/espacepersonnel/courriers/recherche">'
+                   '<input type="radio" name="etat" value="tous" id="tous" checked>'
+                   '<input type="radio" name="etat" value="nonlu" id="nonlu">'
+                   '<input type="text" name="dateDebut" value="">'
+                   '</form>')
+
+    def courriersrecherche(self, url, query):
+        form = self._form()
+        self._listing(form.get("etat", "tous"), form.get("dateDebut", ""), 1)
+
+    def courrierspage(self, url, query):
+        self._listing(query.get("etat", "tous"), query.get("dateDebut", ""), int(query.get("page", 1)))
+
+    def _listing(self, etat, since, page):
+        account = self._account_cookie()
+        if account is None:
+            self._error(403)
+            return
+
+        if since:
+            since = datetime.datetime.strptime(since, "%d/%m/%Y").date()
+        else:
+            since = datetime.date.today() - datetime.timedelta(days=182)
+
+        mails = [m for m in account.mails if m["date"] >= since and (etat != "nonlu" or not m["read"])]
+        if not mails:
+            self._page("<p>Aucun courrier</p>")
+            return
+
+        size = self.state.pagesize
+        npages = (len(mails) + size - 1) // size
+        rows = ['<tr><th>Date</th><th>Objet</th><th>Canal</th><th>PDF</th></tr>']
+        for m in mails[(page - 1) * size:page * size]:
+            rows.append('<tr class="%s"><td class="date">%s</td><td class="avisPaie">%s</td><td class="courrierPap">%s</td>'
+                        '<td class="Telechar"><a href="/espacepersonnel/courriers/doc?id=%s">Télécharger</a></td></tr>'
+                        % ("" if m["read"] else "courrierNonLu", m["date"].strftime("%d/%m/%Y"), html.escape(m["title"]), m["channel"], m["id"]))
+
+        links = []
+        for p in range(1, npages + 1):
+            if p == page:
+                links.append("<span>%d</span>" % p)
+            else:
+                q = urllib.parse.urlencode({"etat": etat, "dateDebut": since.strftime("%d/%m/%Y"), "page": p})
+                links.append('<a href="/espacepersonnel/courriers/page?%s">%d</a>' % (q, p))
+
+        self._page('<table class="listingPyjama">%s</table><div class="pagination">%s</div>' % ("".join(rows), " ".join(links)))
+
+    def courrierdoc(self, url, query):
+        account = self._account_cookie()
+        acc, mail = self.state.mailsbyid.get(query.get("id"), (None, None))
+        if account is None or acc is not account:
+            self._error(404)
+            return
+        self._page('<embed src="/pdf/%s.pdf" type="application/pdf">' % mail["id"])
+
+    def pdf(self, url, query):
+        account = self._account_cookie()
+        mailid = url.path[len("/pdf/"):-len(".pdf")]
+        acc, mail = self.state.mailsbyid.get(mailid, (None, None))
+        if account is None or acc is not account:
+            self._error(404)
+            return
+
+        mail["read"] = True
+        self._send(make_pdf([mail["title"], "Date: %s" % mail["date"].strftime("%d/%m/%Y"),
+                             "Destinataire: %s" % account.username, "Courrier %s" % mail["id"]]), "application/pdf")
+
+
+
+    # Actualisation
+
+    def actustart(self, url, query):
+        if self._account_cookie() is None:
+            self._error(403)
+            return
+        self._page('<form method="post" action="/espacepersonnel/actualisation/init"><input type="hidden" name="jeton" value="x"></form>')
+
+    def actuinit(self, url, query):
+        account = self._account_cookie()
+        self._form()
+        if account.declared == self._period():
+            self._page('<p>Vous avez déjà déclaré votre situation pour cette période</p>'
+                       '<form method="post" action="/espacepersonnel/actualisation/modifier"><input type="hidden" name="modif" value="1"></form>')
+            return
+        self._formation()
+
+    def actumodifier(self, url, query):
+        self._form()
+        self._formation()
+
+    def _formation(self):
+        self._page('<form method="post" action="/espacepersonnel/actualisation/formation"><fieldset>'
+                   '<input type="radio" name="formation" value="OUI"><input type="radio" name="formation" value="NON">'
+                   '</fieldset></form>')
+
+    def actuformation(self, url, query):
+        self._form()
+        blocs = []
+        for blocid, question, opens in QUESTIONS:
+            blocs.append(self._radiobloc(blocid, question, opens))
+
+        subblocs = []
+        for blocid, question, name in SUBQUESTIONS:
+            subblocs.append('<div class="form-line" id="%s"><div class="label"><label for="%s">%s</label></div>'
+                            '<input type="text" name="%s" id="%s"></div>' % (blocid, name, html.escape(question), name, name))
+
+        self._page('<form method="post" action="/espacepersonnel/actualisation/situation">'
+                   '<div><fieldset>%s</fieldset></div>'
+                   '<div id="travail" class="hide"><fieldset>%s</fieldset></div>'
+                   '</form>' % ("".join(blocs), "".join(subblocs)))
+
+    @staticmethod
+    def _radiobloc(blocid, question, opens):
+        name = blocid[:-len("Bloc")]
+        oui = '<input type="radio" name="%s" value="OUI" id="%s"%s>' % (
+            name, (opens + "-open") if opens else name + "-oui", ' class="js-open"' if opens else "")
+        non = '<input type="radio" name="%s" value="NON" id="%s-non">' % (name, name)
+        return ('<div class="form-line" id="%s"><div class="label"><span class="list-title">%s <span>Aide</span></span></div>%s%s</div>'
+                % (blocid, html.escape(question), oui, non))
+
+    def actusituation(self, url, query):
+        account = self._account_cookie()
+        form = self._form()
+        missing = [q[0][:-len("Bloc")] for q in QUESTIONS if q[0][:-len("Bloc")] not in form]
+        if missing:
+            self._error(400, "Missing answers: %r" % missing)
+            return
+
+        lis = "".join("<li>%s : %s</li>" % (html.escape(q), form[b[:-len("Bloc")]]) for b, q, _ in QUESTIONS)
+        self._page('<h2>Récapitulatif de votre déclaration</h2><div class="form-result"><ul>%s</ul></div>'
+                   '<form method="post" action="/espacepersonnel/actualisation/confirmer"><input type="hidden" name="ok" value="1"></form>' % lis)
+
+    def actuconfirmer(self, url, query):
+        account = self._account_cookie()
+        self._form()
+        account.declared = self._period()
+        self._page('<div id="link-redirect"><a href="/espacepersonnel/actualisation/fin">Continuer</a></div>')
+
+    def actufin(self, url, query):
+        self._page('<a class="pdf-fat-link" href="/espacepersonnel/actualisation/declaration.pdf">Déclaration</a>')
+
+    def actupdf(self, url, query):
+        account = self._account_cookie()
+        self._send(make_pdf(["Déclaration de situation", "Compte: %s" % account.username]), "application/pdf")
+
+
+
+ROUTES = {
+    ("GET", "/espacepersonnel/"): Handler.espacepersonnel,
+    ("GET", "/espacepersonnel/main.0123abcd.js"): Handler.mainjs,
+    ("GET", "/connexion/oauth2/authorize"): Handler.authorize,
+    ("GET", "/connexion/XUI/"): Handler.xui,
+    ("GET", "/connexion/json/realms/root/realms/individu/serverinfo/*"): Handler.serverinfo,
+    ("POST", "/connexion/json/realms/root/realms/individu/authenticate"): Handler.authenticate,
+    ("GET", "/api/situations"): Handler.situations,
+    ("GET", "/api/navigation/menu"): Handler.navigation,
+    ("GET", "/api/courriers/nombre"): Handler.courriersnombre,
+    ("GET", "/espacepersonnel/courriers/"): Handler.courriers,
+    ("POST", "/espacepersonnel/courriers/init"): Handler.courriersinit,
+    ("POST", "/espacepersonnel/courriers/recherche"): Handler.courriersrecherche,
+    ("GET", "/espacepersonnel/courriers/page"): Handler.courrierspage,
+    ("GET", "/espacepersonnel/courriers/doc"): Handler.courrierdoc,
+    ("GET", "/espacepersonnel/actualisation/start"): Handler.actustart,
+    ("POST", "/espacepersonnel/actualisation/init"): Handler.actuinit,
+    ("POST", "/espacepersonnel/actualisation/modifier"): Handler.actumodifier,
+    ("POST", "/espacepersonnel/actualisation/formation"): Handler.actuformation,
+    ("POST", "/espacepersonnel/actualisation/situation"): Handler.actusituation,
+    ("POST", "/espacepersonnel/actualisation/confirmer"): Handler.actuconfirmer,
+    ("GET", "/espacepersonnel/actualisation/fin"): Handler.actufin,
+    ("GET", "/espacepersonnel/actualisation/declaration.pdf"): Handler.actupdf,
+}
+
+PREFIXROUTES = {
+    ("GET", "/pdf/"): Handler.pdf,
+}
+
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state, host="127.0.0.1", port=0):
+        super(MockServer, self).__init__((host, port), Handler)
+        self.state = state
+        state.baseurl = "http://%s:%d" % (host, self.server_address[1])
+
+    def start(self):
+        """Serve in a background thread and return the base URL."""
+        thread = threading.Thread(target=self.serve_forever, name="mockserver", daemon=True)
+        thread.start()
+        return self.state.baseurl
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Faux site France Travail pour les tests de charge")
+    parser.add_argument("--host", default="127.0.0.1", help="Adresse d'écoute")
+    parser.add_argument("--port", "-p", type=int, default=8080, help="Port d'écoute")
+    parser.add_argument("--accounts", "-a", type=int, default=10, help="Nombre de comptes (user0000/pwd0000, ...)")
+    parser.add_argument("--mails", "-m", type=int, default=20, help="Nombre de courriers par compte")
+    parser.add_argument("--page-size", type=int, default=10, help="Nombre de courriers par page")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence ajoutée à chaque requête (secondes)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Latence aléatoire supplémentaire maximale (secondes)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Affiche chaque requête")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    state = MockState(args.accounts, args.mails, args.page_size, args.latency, args.jitter)
+    server = MockServer(state, args.host, args.port)
+    logging.info("Serving %d accounts on %s", args.accounts, state.baseurl)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+
+
+class Outbox(object):
+    """On-disk spool of the messages to deliver.
+
+    Each message is written in its own directory before being sent: a
+    message.json file with the headers, the text and the names of the
+    attachments, along with one file per attachment. The directory is only
+    removed once the message has been delivered, so that a delivery failure
+    never requires downloading the courrier again."""
+
+    # Delay before retrying a message that failed, doubled at each failure
+    backoff = 60
+    backoff_max = 6 * 3600
+    # Age after which a message still being written was left by a crash
+    tmp_maxage = 3600
+
+    def __init__(self, path, mailsender):
+        self._path = os.path.expanduser(path)
+        self._mailsender = mailsender
+        self._failed = []
+        self._pending = set()
+        self._removetmp()
+
+
+
+    def _removetmp(self):
+        """Remove the messages left half-written by a crash."""
+        try:
+            names = os.listdir(self._path)
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        for name in names:
+            if not name.startswith(".tmp-"):
+                continue
+            path = self._entrypath(name)
+            try:
+                if now - os.stat(path).st_mtime < self.tmp_maxage:
+                    # May be written by another process right now
+                    continue
+            except FileNotFoundError:
+                continue
+            logging.warning("Removing incomplete message %s from the outbox", name)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+
+    def _entrypath(self, entry):
+        return os.path.join(self._path, entry)
+
+
+
+    def put(self, to, subj, msg, attachments=None):
+        if attachments is None:
+            attachments = []
+
+        os.makedirs(self._path, exist_ok=True)
+        tmpdir = tempfile.mkdtemp(dir=self._path, prefix=".tmp-")
+
+        try:
+            names = []
+            for i, (name, content) in enumerate(attachments):
+                with open(os.path.join(tmpdir, "att-%d" % i), "wb") as fp:
+                    fp.write(content)
+                names.append(name)
+
+            meta = {
+                "to": to,
+                "subject": subj,
+                "text": msg,
+                "attachments": names,
+                "attempts": 0,
+                "nexttry": 0,
+            }
+            self._writemeta(tmpdir, meta)
+
+            # Names sort in the order the messages were spooled
+            entry = "%020d-%d" % (time.time_ns(), os.getpid())
+            os.rename(tmpdir, self._entrypath(entry))
+        except BaseException:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+
+        logging.debug("Spooled message %r as %s", subj, entry)
+        return entry
+
+
+
+    @staticmethod
+    def _writemeta(dirpath, meta):
+        tmppath = os.path.join(dirpath, ".message.json")
+        with open(tmppath, "w") as fp:
+            json.dump(meta, fp, ensure_ascii=False)
+        os.replace(tmppath, os.path.join(dirpath, "message.json"))
+
+
+
+    def _readmeta(self, entry):
+        with open(os.path.join(self._entrypath(entry), "message.json")) as fp:
+            return json.load(fp)
+
+
+
+    def entries(self):
+        try:
+            names = os.listdir(self._path)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if not n.startswith("."))
+
+
+
+    def load(self, entry):
+        """Return the (to, subj, msg, attachments) of an entry."""
+        meta = self._readmeta(entry)
+        attachments = []
+        for i, name in enumerate(meta["attachments"]):
+            with open(os.path.join(self._entrypath(entry), "att-%d" % i), "rb") as fp:
+                attachments.append((name, fp.read()))
+
+        return meta["to"], meta["subject"], meta["text"], attachments
+
+
+
+    def send(self, entry):
+        self._mailsender.message(*self.load(entry))
+        shutil.rmtree(self._entrypath(entry))
+        logging.debug("Delivered and removed message %s", entry)
+
+
+
+    def _sendretry(self, entry):
+        import retrying
+
+        retry = retrying.retry(stop_max_attempt_number=3, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+        try:
+            retry(self.send)(entry)
+        except Exception as e:
+            meta = self._readmeta(entry)
+            meta["attempts"] += 1
+            delay = min(self.backoff * 2 ** (meta["attempts"] - 1), self.backoff_max)
+            meta["nexttry"] = time.time() + delay
+            meta["error"] = repr(e)
+            self._writemeta(self._entrypath(entry), meta)
+
+            logging.error("Could not deliver message %r, kept in outbox as %s: %r", meta["subject"], entry, e)
+            self._failed.append(entry)
+            return False
+
+        return True
+
+
+
+    def _deliverjob(self, entry, subj):
+        try:
+            if self._failed:
+                logging.warning("Delivery failing, message %r left in outbox", subj)
+                self._failed.append(entry)
+                return False
+            return self._sendretry(entry)
+        finally:
+            self._pending.discard(entry)
+
+
+
+    def _submit(self, entry, subj):
+        # All the deliveries go through the mailer so that they happen in
+        # its sender thread when it's started
+        self._pending.add(entry)
+        self._mailsender.submit(subj, self._deliverjob, entry, subj)
+
+
+
+    def message(self, to, subj, msg, attachments=None):
+        """Spool a message and have the mailer deliver it, in its sender
+        thread if it's started. If a delivery already failed during this
+        run, the message is only spooled."""
+        entry = self.put(to, subj, msg, attachments)
+        self._submit(entry, subj)
+
+
+
+    def drain(self, force=False):
+        """Submit for delivery the spooled messages whose retry delay
+        expired, or all of them with force=True. Return the number of
+        messages submitted."""
+        self._removetmp()
+        now = time.time()
+        submitted = 0
+
+        for entry in self.entries():
+            if entry in self._pending:
+                continue
+
+            meta = self._readmeta(entry)
+            if not force and meta["nexttry"] > now:
+                logging.debug("Message %s not due for retry yet", entry)
+                continue
+
+            self._submit(entry, meta["subject"])
+            submitted += 1
+
+        logging.info("Resending %d messages from the outbox", submitted)
+        return submitted
+
+
+
+    def check(self):
+        """Raise if some messages couldn't be delivered during this run."""
+        if self._failed:
+            raise RuntimeError("%d messages could not be delivered and are kept in the outbox %s" % (len(self._failed), self._path))
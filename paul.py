@@ -1,41 +1,74 @@
 import datetime
+import functools
 import json
 import logging
 import random
 import re
 import urllib.parse
 
-import lxml.html
-import requests
-import retrying
+import profiling
+import ratelimit
+import transport
+
+# lxml, requests and retrying are imported where they are used so that
+# the scripts that don't talk to the site start quickly.
 
 
 __all__ = ['PaulEmploi', 'PaulEmploiAuthedRequests', 'default_answers']
 
 
 
-questions = {
-    'travailleBloc': "Avez-vous travaillé ou exercé une activité non salariée ?",
-    'nbHeuresTravBloc': "Heures travaillées dans le mois",
-    'montSalaireBloc': "Montant total de votre ou vos salaires bruts réels ou estimés",
-    'stageBloc': "Avez-vous été en stage ?",
-    'maladieBloc': "Avez-vous été en arrêt maladie ?",
-    'materniteBloc': "Avez-vous été en congé maternité ?",
-    'retraiteBloc': "Percevez-vous une nouvelle pension retraite ?",
-    'invaliditeBloc': "Percevez-vous une nouvelle pensiond'invalidité de 2ème ou 3ème catégorie ?",
-    'rechercheBloc': "Etes-vous toujours à la recherche d'un emploi ?"
-}
+BASEURL = "https://candidat.francetravail.fr"
+
 
-default_answers = {
-    'travailleBloc': "NON",
-    'stageBloc': "NON",
-    'maladieBloc': "NON",
-    'materniteBloc': "NON",
-    'retraiteBloc': "NON",
-    'invaliditeBloc': "NON",
-    'rechercheBloc': "OUI"
+
+# Declarative schema of the actualisation form: the question expected in each
+# block and the default answer if there's one. Compiled by formschema.
+SCHEMA = {
+    'travailleBloc': {'question': "Avez-vous travaillé ou exercé une activité non salariée ?", 'default': "NON"},
+    'nbHeuresTravBloc': {'question': "Heures travaillées dans le mois"},
+    'montSalaireBloc': {'question': "Montant total de votre ou vos salaires bruts réels ou estimés"},
+    'stageBloc': {'question': "Avez-vous été en stage ?", 'default': "NON"},
+    'maladieBloc': {'question': "Avez-vous été en arrêt maladie ?", 'default': "NON"},
+    'materniteBloc': {'question': "Avez-vous été en congé maternité ?", 'default': "NON"},
+    'retraiteBloc': {'question': "Percevez-vous une nouvelle pension retraite ?", 'default': "NON"},
+    'invaliditeBloc': {'question': "Percevez-vous une nouvelle pensiond'invalidité de 2ème ou 3ème catégorie ?", 'default': "NON"},
+    'rechercheBloc': {'question': "Etes-vous toujours à la recherche d'un emploi ?", 'default': "OUI"},
 }
 
+questions = {blocid: q['question'] for blocid, q in SCHEMA.items()}
+default_answers = {blocid: q['default'] for blocid, q in SCHEMA.items() if 'default' in q}
+
+_formschema = None
+
+
+
+def compiled_schema():
+    """The schema compiled on first use."""
+    global _formschema
+    if _formschema is None:
+        import formschema
+        _formschema = formschema.FormSchema(SCHEMA)
+    return _formschema
+
+
+
+def retry(func):
+    """Retry func like all the calls to the site, importing retrying on the
+    first call."""
+    retried = None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        nonlocal retried
+        if retried is None:
+            import retrying
+            deco = retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+            retried = deco(func)
+        return retried(*args, **kwargs)
+
+    return wrapper
+
 
 
 def extract_json(script, tagre):
@@ -104,8 +137,10 @@ def buildAuthorizeUrl(peam):
 
 
 class PaulEmploiAuthedRequests(object):
-    def __init__(self, user, password):
-        self._session = requests.Session()
+    def __init__(self, user, password, baseurl=None):
+        self._baseurl = baseurl or BASEURL
+        # Cookies and tokens are per account, the connections are shared
+        self._session = transport.session()
         self._session.headers.update({'User-Agent': 'Mozzarella/5.0'})
         self._peam = None
         self._rest = None
@@ -115,19 +150,17 @@ class PaulEmploiAuthedRequests(object):
 
 
     def request(self, method, url, *args, **kwargs):
+        ratelimit.limiter.wait(url)
         res = self._session.request(method, url, *args, **kwargs)
         res.raise_for_status()
         return res
 
     def get(self, url, *args, **kwargs):
-        res = self._session.get(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, *args, **kwargs)
 
     def post(self, url, *args, **kwargs):
-        res = self._session.post(url, *args, **kwargs)
-        res.raise_for_status()
-        return res
+        return self.request('POST', url, *args, **kwargs)
 
     def getjson(self, url, add_headers={}):
         headers = {
@@ -142,8 +175,11 @@ class PaulEmploiAuthedRequests(object):
 
 
 
+    @profiling.profiled("discovery")
     def _authorizeUrl(self):
-        initialurl = "https://candidat.francetravail.fr/espacepersonnel/"
+        import lxml.html
+
+        initialurl = self._baseurl + "/espacepersonnel/"
         res = self.get(initialurl)
 
         doc = lxml.html.fromstring(res.text, base_url=res.url)
@@ -255,7 +291,8 @@ class PaulEmploiAuthedRequests(object):
 
 
 
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("login")
+    @retry
     def _login(self, user, password):
         authorizeurl = self._authorizeUrl()
         res = self.get(authorizeurl)
@@ -288,13 +325,15 @@ class PaulEmploiAuthedRequests(object):
 
 
 
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("situation")
+    @retry
     def getSituationsUtilisateur(self):
         return self.getjson(self._rest['ex002']['situationsUtilisateur'])
 
 
 
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("discovery")
+    @retry
     def getNavigation(self):
         d = self._rest['ex017']
         type_auth = self._peam['id']
@@ -310,8 +349,9 @@ class PaulEmploiAuthedRequests(object):
 
 
 class PaulEmploi(object):
-    def __init__(self, user, password):
-        self._req = PaulEmploiAuthedRequests(user, password)
+    def __init__(self, user, password, baseurl=None, formcache=None):
+        self._req = PaulEmploiAuthedRequests(user, password, baseurl)
+        self._formcache = formcache
         self._situationsUtilisateur = None
         self._navigation = None
 
@@ -331,6 +371,11 @@ class PaulEmploi(object):
 
 
 
+    def count_unread(self):
+        return self._req.count_unread()
+
+
+
     def navigation_service_url(self, path):
         navigation = self.getNavigation()
 
@@ -353,72 +398,46 @@ class PaulEmploi(object):
 
 
 
-    def _fill_block(self, bloc, answers):
-        blocid = bloc.get('id')
-        logging.debug("Filling block %s", blocid)
-
-        # Check that the question hasn't changed
-        qs = bloc.cssselect('.label > .list-title')
-        if len(qs) == 0:
-            qs = bloc.cssselect(".label > label")
-        assert len(qs) == 1, "Several questions for a block"
-        q = qs[0]
-        q = lxml.html.tostring(qs[0], method='text', encoding='unicode')
-        matches = re.match(r'^\s*(.*?)\s*(?:Aide\s*)?$', q, re.MULTILINE)
-        q = matches.group(1)
-        logging.debug("Answering question %r", q)
-
-        if blocid not in questions:
-            blocstr = lxml.html.tostring(bloc, encoding='unicode')
-            raise ValueError("Unknown question block: %s" % blocstr)
-
-        if questions[blocid] != q:
-            raise ValueError("Question changed for block '%s'. Expected %r found %r" % (blocid, questions[blocid], q))
-
-        inputs = bloc.cssselect("input")
-        inputnames = set(i.name for i in inputs)
-        if len(inputnames) == 0:
-            blocstr = lxml.html.tostring(bloc, encoding='unicode')
-            raise ValueError("No input in block '%s'\nPlease check the form yourself:\n%s" % (blocid, blocstr))
+    def _fill_form(self, form, answers):
+        """Fill the form from the cached field map if it's structurally
+        identical to a form already validated, validate it fully otherwise."""
+        import formschema as fs
 
-        if len(inputnames) > 1:
-            blocstr = lxml.html.tostring(bloc, encoding='unicode')
-            raise ValueError("Several inputs for question %r\nPlease check the form yourself:\n%s" % (q, blocstr))
+        schema = compiled_schema()
+        cache = fs.FormCache(self._formcache)
+        description = schema.describe(form)
+        fingerprint = schema.fingerprint(description)
 
-        inputtype = inputs[0].type.lower()
+        diff = None
+        fieldmap = cache.get(fingerprint)
+        if fieldmap is not None:
+            formvalues = schema.fill(form, fieldmap, answers)
+            if formvalues is not None:
+                logging.debug("Form %s already validated, filled from the field map", fingerprint[:12])
+                return formvalues
+            logging.debug("Answers lead to unvalidated parts of form %s", fingerprint[:12])
+        else:
+            diff = cache.diff(description)
 
-        if inputtype not in ("text", "radio"):
-            raise ValueError("Found an input with type %r. Those aren't supported yet." % inputtype)
+        try:
+            formvalues, fieldmap = schema.validate(form, answers)
+        except ValueError as e:
+            if diff:
+                raise ValueError("%s\nChanges since the last validated form:\n%s" % (e, diff)) from e
+            raise
 
-        if inputtype == "text":
-            return inputs[0].name, answers[blocid], None
+        if diff:
+            logging.info("Actualisation form changed since the last validated one:\n%s", diff)
+        cache.put(fingerprint, description, fieldmap)
+        return formvalues
 
-        # Check that our answer doesn't show a new question
-        inputs = bloc.cssselect('input[value=%s]' % answers[blocid])
-        if len(inputs) == 0:
-            inputs = bloc.cssselect('input')
-            values = [i.value for i in inputs]
-            blocstr = lxml.html.tostring(bloc, encoding='unicode')
-            raise ValueError("No input for question %r with value %r. Possible values are %r\nPlease check the form yourself:\n%s" % (q, answers[blocid], values, blocstr))
 
-        if len(inputs) > 1:
-            blocstr = lxml.html.tostring(bloc, encoding='unicode')
-            raise ValueError("Several inputs for question %r with value %r.\nPlease check the form yourself:\n%s" % (q, answers[blocid], blocstr))
 
-        input_ = inputs[0]
-        openid = None
-        if "js-open" in input_.classes:
-            inputid = input_.get('id')
-            if inputid.endswith("-open"):
-                openid = inputid[:-len("-open")]
-                logging.debug("Answering %r to question %r opens block %r.", answers[blocid], q, openid)
-
-        return input_.name, answers[blocid], openid
-
-
-
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("actualisation")
+    @retry
     def actualisation(self, answers):
+        import lxml.html
+
         url = self.navigation_service_url("dossier-de/actualisation/m-actualiser")
         res = self._req.get(url)
         doc = lxml.html.fromstring(res.text, base_url=res.url)
@@ -464,24 +483,8 @@ class PaulEmploi(object):
         assert len(forms) == 1, "Several forms for actualisation"
         form = forms[0]
 
-        formvalues = dict(form.fields)
-        blocs = form.cssselect("div:not(.hide) > fieldset:not([id]) > div.form-line:not(.js-hide)")
-        for bloc in blocs:
-            name, value, showid = self._fill_block(bloc, answers)
-            formvalues[name] = value
-
-            if showid is not None:
-                blocshow = form.cssselect("#" + showid)
-                if len(blocshow) == 0:
-                    raise ValueError("Block '%s' should be shown but doesn't exist" % showid)
-
-                blocshow = blocshow[0]
-                newblocs = blocshow.cssselect("div.form-line")
-                for b in newblocs:
-                    name, value, n = self._fill_block(b, answers)
-                    formvalues[name] = value
-                    if n is not None:
-                        raise ValueError("Question block '%s' opened block '%s' which should open a second third level block '%r'. Only 2 levels supported right now." % (bloc.get("id"), showid, n))
+        with profiling.phase("form fill"):
+            formvalues = self._fill_form(form, answers)
 
         res = self._req.request(form.method, form.action, data=formvalues)
         doc = lxml.html.fromstring(res.text, base_url=res.url)
@@ -557,6 +560,8 @@ class PaulEmploi(object):
 
 
     def _all_mails_desc(self, doc):
+        import lxml.html
+
         pyjamas = doc.cssselect('table.listingPyjama')
         if len(pyjamas) == 0:
             return []
@@ -585,8 +590,11 @@ class PaulEmploi(object):
 
 
 
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("listing")
+    @retry
     def newmails(self, allmessages=False, since=None):
+        import lxml.html
+
         url = self.navigation_service_url("contacts-documents/documents/courriers-recus-pe")
         res = self._req.get(url)
         doc = lxml.html.fromstring(res.content, base_url=res.url)
@@ -628,8 +636,11 @@ class PaulEmploi(object):
 
 
 
-    @retrying.retry(stop_max_attempt_number=3, stop_max_delay=3600000, wait_exponential_multiplier=1000, wait_exponential_max=10000)
+    @profiling.profiled("download")
+    @retry
     def download_mail(self, link):
+        import lxml.html
+
         res = self._req.get(link)
         doc = lxml.html.fromstring(res.content, base_url=res.url)
         doc.make_links_absolute()
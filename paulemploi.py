@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import datetime
+import json
+import locale
+import logging
+import logging.config
+import os
+import sys
+import traceback
+
+import accountlock
+import autovalidate
+import history
+import mailer
+import mailmessages
+import outbox
+import paul
+import profiling
+import ratelimit
+import transport
+
+
+
+SELFPATH = os.path.dirname(os.path.realpath(sys.argv[0]))
+
+
+
+def logging_getHandler(name):
+    for h in logging.getLogger().handlers:
+        if h.name == name:
+            return h
+    return None
+
+
+
+def setverbosity(verbose):
+    """Raise or lower the console log level by verbose steps."""
+    loglevels = ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"]
+    ch = logging_getHandler("consoleHandler")
+    curlevel = logging.getLevelName(ch.level)
+    curlevel = loglevels.index(curlevel)
+    verbose = min(len(loglevels) - 1, max(0, curlevel + verbose))
+    ch.setLevel(loglevels[verbose])
+
+
+
+def statedir(config):
+    default = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "paulemploi")
+    return os.path.expanduser(config.get("State", "statedir", fallback=default))
+
+
+
+class Account(object):
+    def __init__(self, config, section):
+        self.section = section
+        self.name = section[len("Account."):]
+        self.username = config[section]["username"]
+        self.password = config[section]["password"]
+        self.email = config[section]["email"]
+        self.rootdir = statedir(config)
+        self.statedir = os.path.join(self.rootdir, self.name)
+        self.baseurl = config.get("Site", "baseurl", fallback=None)
+        # The actualisation form is the same for every account
+        self.formcache = os.path.join(self.rootdir, "actualisation-form.json")
+        self.history = history.SituationHistory(os.path.join(self.statedir, "situation-history.gz"))
+        self._pe = None
+
+
+
+    @property
+    def pe(self):
+        """The PaulEmploi session of this account, logged in on first use and
+        shared by all the tasks."""
+        if self._pe is None:
+            logging.info("Logging in as %s", self.username)
+            self._pe = paul.PaulEmploi(self.username, self.password, self.baseurl, self.formcache)
+        return self._pe
+
+
+
+    def reset(self):
+        """Forget the session, the next use logs in again."""
+        self._pe = None
+
+
+
+    def declared(self):
+        """The last period (periodeCourante) this account was actualised for
+        by us, or None."""
+        try:
+            with open(os.path.join(self.statedir, "declared")) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            logging.warning("Ignoring unreadable declared period of %s: %s", self.name, e)
+            return None
+
+
+
+    def mark_declared(self, periode):
+        os.makedirs(self.statedir, exist_ok=True)
+        path = os.path.join(self.statedir, "declared")
+        with open(path + ".tmp", "w") as fp:
+            json.dump(periode, fp)
+        os.replace(path + ".tmp", path)
+
+
+
+def smtp_backend(smtpconfig):
+    smtphost = smtpconfig["smtphost"]
+    smtpport = smtpconfig.get("smtpport")
+    smtpauth = smtpconfig.get("smtpauth", smtpconfig.get("smtpauthmethod"))
+    smtpuser = smtpconfig.get("smtpuser")
+    smtppassword = smtpconfig.get("smtppwd")
+    smtpoauthcmd = smtpconfig.get("smtpoauthtokencmd")
+
+    smtp = mailer.SMTPBackend(smtphost, smtpport, smtpauth,
+                              smtpuser, smtppassword, smtpoauthcmd)
+    return smtp, smtpuser
+
+
+
+def delivery_backend(accountconfig, smtp):
+    delivery = accountconfig.get("delivery", "smtp").lower()
+    if delivery == "smtp":
+        if smtp is None:
+            raise ValueError("SMTP delivery requires a [SMTP] section")
+        return smtp
+
+    if delivery not in mailer.BACKENDS:
+        raise ValueError("Unknown delivery method %r" % delivery)
+
+    path = accountconfig["deliverypath"]
+    logging.info("Delivering messages with %s to %s", delivery, path)
+    return mailer.BACKENDS[delivery](path)
+
+
+
+def status(account):
+    pe = account.pe
+    situation = pe.getSituationsUtilisateur()
+    account.history.record(situation)
+    actualisation = situation['actualisation']
+
+    print("Compte:", account.name)
+    if 'periodeCourante' in actualisation:
+        ref = datetime.datetime.fromisoformat(actualisation['periodeCourante']['reference'])
+        print("Actualisation ouverte pour le mois de", ref.strftime("%B %Y"))
+    else:
+        print("Pas d'actualisation en cours")
+
+    print(autovalidate.msgindemn(situation['indemnisation'], datetime.date.today()).rstrip())
+    print("Courriers non-lus:", pe.count_unread())
+
+
+
+def run_task(task, args, account, spool):
+    logging.info("Running task %s for account %s", task, account.name)
+
+    if task == "actualise":
+        autovalidate.dostuff(spool, account.email, account.pe, args.work, account.history, account.mark_declared)
+    elif task == "mails":
+        index = None
+        if not args.no_send:
+            spool.drain()
+            import search
+            try:
+                index = search.Index(search.indexpath(account.rootdir))
+            except Exception as e:
+                logging.warning("Could not open the index of the courriers: %r", e)
+
+        try:
+            mailmessages.dostuff(spool, account.email, account.pe, args.all, args.since, args.no_send, index, account.name)
+        finally:
+            if index is not None:
+                index.close()
+    elif task == "status":
+        status(account)
+    elif task == "flush":
+        spool.drain(force=True)
+    else:
+        raise ValueError("Unknown task %r" % task)
+
+
+
+TASKS = ["actualise", "mails", "status", "flush"]
+
+
+
+def main(default_tasks=None, description="Bot pour Paul Emploi"):
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("tasks", metavar="task", nargs="*", help="Tâches à effectuer dans l'ordre: %s" % ", ".join(TASKS))
+    parser.add_argument("--user", "-u", metavar="PEusername", help="Compte Pôle Emploi configuré à utiliser")
+    parser.add_argument("--work", "-w", metavar="worklog", action="append", help="Fichier des heures travaillées, peut être répété")
+    parser.add_argument("--all", action='store_true', help="Envoie tous les messages et pas seulement ceux non-lus")
+    parser.add_argument("--since", metavar="JJ/MM/AAAA", help="Envoie uniquement les messages reçus après cette date")
+    parser.add_argument("--no-send", "-n", action='store_true', help="N'envoie pas les mails, affiche le résumé")
+    parser.add_argument("--wait", metavar="SECONDES", type=float, default=0, help="Attend que l'exécution en cours pour ce compte se termine")
+    parser.add_argument("--profile", metavar="FICHIER", help="Profile les différentes phases et écrit les statistiques dans ce fichier")
+    parser.add_argument("--no-error-mail", action="store_true", help="N'envoie pas de mail pour les erreurs")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_intermixed_args()
+
+    configpath = args.cfgfile
+    peuser = args.user
+    verbose = args.verbose - args.quiet
+    tasks = args.tasks or default_tasks
+    errormail = not args.no_error_mail
+
+    if not tasks:
+        parser.error("no task given")
+
+    for task in tasks:
+        if task not in TASKS:
+            parser.error("unknown task %r (choose from %s)" % (task, ", ".join(TASKS)))
+
+    setverbosity(verbose)
+
+    if args.profile:
+        profiling.enable()
+
+    logging.info("Reading config file %s", configpath)
+    config = configparser.ConfigParser()
+    config.read(configpath)
+
+    ratelimit.configure_from(config, statedir(config))
+    transport.configure_from(config)
+
+    smtp = None
+    smtpuser = None
+    if config.has_section("SMTP"):
+        smtp, smtpuser = smtp_backend(config["SMTP"])
+
+    if peuser is None:
+        section = next(s for s in config.sections() if s.startswith("Account."))
+    else:
+        section = "Account." + peuser
+
+    logging.info("Using account section %s", section)
+    logging_getHandler("memoryHandler").select(section)
+    account = Account(config, section)
+
+    backend = delivery_backend(config[section], smtp)
+    mailsender = mailer.Mailer(backend, smtpuser or account.email)
+
+    # Every message goes through the outbox before being delivered
+    spool = outbox.Outbox(os.path.join(account.statedir, "outbox"), mailsender)
+
+    # Errors are reported to the SMTP account if there is one
+    errorsender = mailer.Mailer(smtp, smtpuser) if smtp else mailsender
+    errorto = smtpuser or account.email
+
+    # Don't run concurrently with another invocation for the same account
+    lock = accountlock.AccountLock(os.path.join(account.statedir, "lock"), args.wait)
+    try:
+        lock.acquire()
+    except accountlock.AccountLocked as e:
+        logging.info("%s, exiting", e)
+        sys.exit(os.EX_TEMPFAIL)
+
+    try:
+        # Keep the delivery backend open (SMTP connection, mbox lock) for all the tasks
+        with mailsender:
+            mailsender.start()
+            try:
+                for task in tasks:
+                    run_task(task, args, account, spool)
+            except BaseException:
+                mailsender.join(reraise=False)
+                raise
+
+            mailsender.join()
+            spool.check()
+    except KeyboardInterrupt:
+        raise
+    except:
+        logging.exception("Top-level exception:")
+        if not errormail:
+            raise
+
+        msg = "Exception caught while trying to run %s.\n\n" % ", ".join("\"%s\"" % t for t in tasks)
+        msg += traceback.format_exc()
+        logs = logging_getHandler("memoryHandler").gzipped()
+        errorsender.error(errorto, msg, attachments=[("debug.log.gz", logs)])
+    finally:
+        lock.release()
+        logging.debug("Requests per host:\n%s", ratelimit.limiter.summary())
+        if args.profile:
+            sys.stderr.write(profiling.dump(args.profile))
+            sys.stderr.write(ratelimit.limiter.summary())
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,671 @@
+"""Pure Python extraction of the text of the PDF courriers.
+
+Only what's needed to index the text is supported: the objects, including
+those in object streams, the Flate, ASCIIHex and ASCII85 filters, the
+ToUnicode CMaps and the simple font encodings. The text is taken from the
+text showing operators of the page content streams and of the forms they
+draw, with line breaks wherever the text moves to another line. Encrypted
+PDFs and images aren't supported."""
+
+import base64
+import re
+import unicodedata
+import zlib
+
+
+
+_WHITESPACE = b" \t\r\n\x00\x0c"
+_REGULAR = re.compile(rb"[^ \t\r\n\x00\x0c()<>\[\]{}/%]+")
+_OBJHEADER = re.compile(rb"(\d+)\s+(\d+)\s+obj\b")
+_ESCAPES = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f"}
+
+
+
+class Name(str):
+    pass
+
+
+
+class Keyword(str):
+    pass
+
+
+
+class Ref(tuple):
+    pass
+
+
+
+class _Lexer(object):
+    """Tokens of PDF objects and content streams: bytes for the strings,
+    Name, Keyword (operators and delimiters), int and float."""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self._pushed = []
+
+
+
+    def push(self, token):
+        self._pushed.append(token)
+
+
+
+    def _literal(self, pos):
+        data = self.data
+        out = bytearray()
+        depth = 1
+        while pos < len(data):
+            c = data[pos]
+            pos += 1
+            if c == 0x5c:
+                e = data[pos:pos + 1]
+                pos += 1
+                if not e:
+                    break
+                if e[0] in _ESCAPES:
+                    out += _ESCAPES[e[0]]
+                elif e in b"01234567":
+                    m = re.match(rb"[0-7]{1,3}", data[pos - 1:pos + 2])
+                    out.append(int(m.group(), 8) & 0xff)
+                    pos += len(m.group()) - 1
+                elif e == b"\r":
+                    if data[pos:pos + 1] == b"\n":
+                        pos += 1
+                elif e != b"\n":
+                    out += e
+            elif c == 0x28:
+                depth += 1
+                out.append(c)
+            elif c == 0x29:
+                depth -= 1
+                if depth == 0:
+                    break
+                out.append(c)
+            else:
+                out.append(c)
+        return bytes(out), pos
+
+
+
+    def next(self):
+        """Return the next token, or None at the end."""
+        if self._pushed:
+            return self._pushed.pop()
+
+        data = self.data
+        n = len(data)
+        pos = self.pos
+        while True:
+            while pos < n and data[pos] in _WHITESPACE:
+                pos += 1
+            if pos < n and data[pos] == 0x25:
+                while pos < n and data[pos] not in b"\r\n":
+                    pos += 1
+                continue
+            break
+
+        if pos >= n:
+            self.pos = pos
+            return None
+
+        c = data[pos:pos + 1]
+        if c == b"(":
+            token, pos = self._literal(pos + 1)
+        elif c == b"<":
+            if data[pos + 1:pos + 2] == b"<":
+                token, pos = Keyword("<<"), pos + 2
+            else:
+                end = data.find(b">", pos)
+                end = n if end < 0 else end
+                digits = re.sub(rb"[^0-9a-fA-F]", b"", data[pos + 1:end])
+                if len(digits) % 2:
+                    digits += b"0"
+                token, pos = bytes.fromhex(digits.decode()), end + 1
+        elif c == b">":
+            token, pos = Keyword(">>"), pos + (2 if data[pos + 1:pos + 2] == b">" else 1)
+        elif c in b"[]{}":
+            token, pos = Keyword(c.decode()), pos + 1
+        elif c == b"/":
+            m = _REGULAR.match(data, pos + 1)
+            raw = m.group() if m else b""
+            raw = re.sub(rb"#([0-9a-fA-F]{2})", lambda m: bytes([int(m.group(1), 16)]), raw)
+            token, pos = Name(raw.decode("latin-1")), pos + 1 + (len(m.group()) if m else 0)
+        else:
+            m = _REGULAR.match(data, pos)
+            if m is None:
+                # Stray delimiter
+                token, pos = Keyword(c.decode("latin-1")), pos + 1
+            else:
+                raw = m.group()
+                pos = m.end()
+                try:
+                    token = int(raw)
+                except ValueError:
+                    try:
+                        token = float(raw)
+                    except ValueError:
+                        token = Keyword(raw.decode("latin-1"))
+
+                if token == "ID":
+                    # Skip the binary data of inline images
+                    end = re.compile(rb"\sEI(?=[\s]|$)").search(data, pos)
+                    pos = end.end() if end else n
+                    token = Keyword("EI")
+
+        self.pos = pos
+        return token
+
+
+
+    def object(self):
+        """Parse the next object, resolving "n g R" into Ref."""
+        token = self.next()
+        if token == "<<":
+            d = {}
+            while True:
+                key = self.next()
+                if key is None or key == ">>":
+                    return d
+                d[key] = self.object()
+        if token == "[":
+            a = []
+            while True:
+                t = self.next()
+                if t is None or t == "]":
+                    return a
+                self.push(t)
+                a.append(self.object())
+        if isinstance(token, int):
+            gen = self.next()
+            if isinstance(gen, int):
+                r = self.next()
+                if r == "R":
+                    return Ref((token, gen))
+                self.push(r)
+            self.push(gen)
+        return token
+
+
+
+def _decode(data, filters, parms):
+    if not isinstance(filters, list):
+        filters = [filters]
+    if not isinstance(parms, list):
+        parms = [parms] * len(filters)
+
+    for f, p in zip(filters, parms):
+        if f in ("FlateDecode", "Fl"):
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                # Some producers write truncated or checksum-less streams
+                data = zlib.decompressobj().decompress(data)
+            if isinstance(p, dict) and p.get("Predictor", 1) >= 10:
+                data = _unpredict(data, p.get("Columns", 1) * p.get("Colors", 1))
+        elif f in ("ASCIIHexDecode", "AHx"):
+            digits = re.sub(rb"[^0-9a-fA-F]", b"", data.split(b">")[0])
+            data = bytes.fromhex((digits + b"0" * (len(digits) % 2)).decode())
+        elif f in ("ASCII85Decode", "A85"):
+            data = base64.a85decode(data.strip().split(b"~>")[0].lstrip(b"<~"), ignorechars=_WHITESPACE)
+        elif f is not None:
+            raise ValueError("Unsupported filter %s" % f)
+    return data
+
+
+
+def _unpredict(data, columns):
+    """Undo the PNG predictors (used by the xref and object streams)."""
+    out = bytearray()
+    prev = bytearray(columns)
+    for i in range(0, len(data), columns + 1):
+        kind, row = data[i], bytearray(data[i + 1:i + 1 + columns])
+        for j in range(len(row)):
+            left = row[j - 1] if j else 0
+            if kind == 1:
+                row[j] = (row[j] + left) & 0xff
+            elif kind == 2:
+                row[j] = (row[j] + prev[j]) & 0xff
+            elif kind == 3:
+                row[j] = (row[j] + (left + prev[j]) // 2) & 0xff
+            elif kind == 4:
+                up, upleft = prev[j], prev[j - 1] if j else 0
+                p = left + up - upleft
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+                pred = left if pa <= pb and pa <= pc else up if pb <= pc else upleft
+                row[j] = (row[j] + pred) & 0xff
+        out += row
+        prev = row
+    return bytes(out)
+
+
+
+class Stream(object):
+    def __init__(self, attrs, raw):
+        self.attrs = attrs
+        self.raw = raw
+
+    def data(self):
+        return _decode(self.raw, self.attrs.get("Filter"), self.attrs.get("DecodeParms"))
+
+
+
+class Document(object):
+    def __init__(self, data):
+        if not data.startswith(b"%PDF"):
+            raise ValueError("Not a PDF file")
+        if b"/Encrypt" in data:
+            raise ValueError("Encrypted PDF")
+
+        self._data = data
+        self._offsets = {}
+        self._instream = {}
+        self._cache = {}
+
+        # Later definitions (incremental updates) override the previous ones
+        for m in _OBJHEADER.finditer(data):
+            self._offsets[int(m.group(1))] = m.end()
+
+        for num, offset in list(self._offsets.items()):
+            if b"/ObjStm" in data[offset:offset + 256]:
+                self._loadobjstm(num)
+
+
+
+    def _loadobjstm(self, num):
+        stm = self.get(num)
+        if not isinstance(stm, Stream) or stm.attrs.get("Type") != "ObjStm":
+            return
+        try:
+            data = stm.data()
+        except (ValueError, zlib.error):
+            return
+
+        first = self.resolve(stm.attrs.get("First", 0))
+        lexer = _Lexer(data)
+        for _ in range(self.resolve(stm.attrs.get("N", 0))):
+            objnum, offset = lexer.next(), lexer.next()
+            if not isinstance(objnum, int) or not isinstance(offset, int):
+                break
+            if objnum not in self._offsets:
+                self._instream[objnum] = (data, first + offset)
+
+
+
+    def _parse(self, num):
+        if num in self._offsets:
+            lexer = _Lexer(self._data, self._offsets[num])
+            obj = lexer.object()
+            if isinstance(obj, dict) and lexer.next() == "stream":
+                return self._stream(obj, lexer.pos)
+            return obj
+
+        if num in self._instream:
+            data, offset = self._instream[num]
+            return _Lexer(data, offset).object()
+
+        return None
+
+
+
+    def _stream(self, attrs, pos):
+        data = self._data
+        if data[pos:pos + 2] == b"\r\n":
+            pos += 2
+        elif data[pos:pos + 1] in (b"\r", b"\n"):
+            pos += 1
+
+        length = attrs.get("Length")
+        if isinstance(length, Ref):
+            length = self.get(length[0])
+        if not isinstance(length, int) or data[pos + length:pos + length + 20].find(b"endstream") < 0:
+            end = data.find(b"endstream", pos)
+            length = (end if end >= 0 else len(data)) - pos
+
+        return Stream(attrs, data[pos:pos + length])
+
+
+
+    def get(self, num):
+        if num not in self._cache:
+            # Guard against reference loops while parsing
+            self._cache[num] = None
+            self._cache[num] = self._parse(num)
+        return self._cache[num]
+
+
+
+    def resolve(self, obj):
+        depth = 0
+        while isinstance(obj, Ref) and depth < 32:
+            obj = self.get(obj[0])
+            depth += 1
+        return obj
+
+
+
+    def pages(self):
+        """Yield the (page dict, resources) in order."""
+        catalog = None
+        for num in self._offsets.keys() | self._instream.keys():
+            obj = self.get(num)
+            if isinstance(obj, dict) and obj.get("Type") == "Catalog":
+                catalog = obj
+                break
+
+        if catalog is None:
+            # Damaged file, take the pages in the order they're found
+            for num in sorted(self._offsets.keys() | self._instream.keys()):
+                obj = self.get(num)
+                if isinstance(obj, dict) and obj.get("Type") == "Page":
+                    yield obj, self.resolve(obj.get("Resources")) or {}
+            return
+
+        seen = set()
+
+        def walk(node, resources):
+            if id(node) in seen:
+                return
+            seen.add(id(node))
+            resources = self.resolve(node.get("Resources", resources)) or {}
+            if "Kids" in node:
+                for kid in self.resolve(node["Kids"]) or []:
+                    kid = self.resolve(kid)
+                    if isinstance(kid, dict):
+                        yield from walk(kid, resources)
+            else:
+                yield node, resources
+
+        root = self.resolve(catalog.get("Pages"))
+        if isinstance(root, dict):
+            yield from walk(root, {})
+
+
+
+# Accents of the glyph names of the Latin letters, eg. "eacute"
+_ACCENTS = {
+    "acute": "ACUTE", "grave": "GRAVE", "circumflex": "CIRCUMFLEX",
+    "dieresis": "DIAERESIS", "cedilla": "CEDILLA", "tilde": "TILDE", "ring": "RING ABOVE",
+}
+
+_GLYPHS = {
+    "space": " ", "exclam": "!", "quotedbl": '"', "numbersign": "#", "dollar": "$",
+    "percent": "%", "ampersand": "&", "quotesingle": "'", "quoteright": "’",
+    "quoteleft": "‘", "parenleft": "(", "parenright": ")", "asterisk": "*",
+    "plus": "+", "comma": ",", "hyphen": "-", "period": ".", "slash": "/",
+    "colon": ":", "semicolon": ";", "less": "<", "equal": "=", "greater": ">",
+    "question": "?", "at": "@", "bracketleft": "[", "backslash": "\\",
+    "bracketright": "]", "underscore": "_", "euro": "€", "degree": "°",
+    "guillemotleft": "«", "guillemotright": "»", "endash": "–",
+    "emdash": "—", "bullet": "•", "ellipsis": "…", "oe": "œ",
+    "OE": "Œ", "ae": "æ", "AE": "Æ", "germandbls": "ß",
+    "quotedblleft": "“", "quotedblright": "”", "nbspace": " ",
+    "zero": "0", "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
+    "six": "6", "seven": "7", "eight": "8", "nine": "9",
+}
+
+
+
+def glyphchar(name):
+    """Character of a glyph name, or None."""
+    if name in _GLYPHS:
+        return _GLYPHS[name]
+    if len(name) == 1:
+        return name
+    m = re.fullmatch(r"uni([0-9A-Fa-f]{4})", name) or re.fullmatch(r"u([0-9A-Fa-f]{4,6})", name)
+    if m:
+        return chr(int(m.group(1), 16))
+    if name[1:] in _ACCENTS and name[0].isalpha():
+        case = "CAPITAL" if name[0].isupper() else "SMALL"
+        try:
+            return unicodedata.lookup("LATIN %s LETTER %s WITH %s" % (case, name[0].upper(), _ACCENTS[name[1:]]))
+        except KeyError:
+            return None
+    return None
+
+
+
+class Font(object):
+    """Decode the strings shown with a font."""
+
+    _ENCODINGS = {"WinAnsiEncoding": "cp1252", "MacRomanEncoding": "mac_roman"}
+
+    def __init__(self, doc, font):
+        self.codelen = 2 if font.get("Subtype") == "Type0" else 1
+        self.cmap = None
+        self.codec = "latin-1"
+        self.differences = {}
+
+        tounicode = doc.resolve(font.get("ToUnicode"))
+        if isinstance(tounicode, Stream):
+            try:
+                self._loadcmap(tounicode.data())
+            except (ValueError, zlib.error):
+                self.cmap = None
+
+        encoding = doc.resolve(font.get("Encoding"))
+        if isinstance(encoding, dict):
+            self.codec = self._ENCODINGS.get(encoding.get("BaseEncoding"), "cp1252")
+            code = 0
+            for item in doc.resolve(encoding.get("Differences")) or []:
+                if isinstance(item, int):
+                    code = item
+                elif isinstance(item, Name):
+                    char = glyphchar(item)
+                    if char is not None:
+                        self.differences[code] = char
+                    code += 1
+        elif encoding in self._ENCODINGS:
+            self.codec = self._ENCODINGS[encoding]
+
+
+
+    def _loadcmap(self, data):
+        self.cmap = {}
+        lengths = set()
+        lexer = _Lexer(data)
+        operands = []
+
+        while True:
+            token = lexer.next()
+            if token is None:
+                break
+            if not isinstance(token, Keyword) or token in ("[", "]"):
+                operands.append(token)
+                continue
+
+            if token == "endcodespacerange":
+                for lo in operands[0::2]:
+                    if isinstance(lo, bytes):
+                        lengths.add(len(lo))
+            elif token == "endbfchar":
+                for src, dst in zip(operands[0::2], operands[1::2]):
+                    if isinstance(src, bytes) and isinstance(dst, bytes):
+                        self.cmap[src] = dst.decode("utf-16-be", "replace")
+                        lengths.add(len(src))
+            elif token == "endbfrange":
+                self._bfrange(operands, lengths)
+            operands = []
+
+        self.lengths = sorted(lengths, reverse=True) or [self.codelen]
+
+
+
+    def _bfrange(self, operands, lengths):
+        i = 0
+        while i + 2 < len(operands):
+            lo, hi = operands[i], operands[i + 1]
+            i += 2
+            if operands[i] == "[":
+                i += 1
+                dsts = []
+                while i < len(operands) and operands[i] != "]":
+                    dsts.append(operands[i])
+                    i += 1
+                i += 1
+            else:
+                dsts = operands[i]
+                i += 1
+
+            if not isinstance(lo, bytes) or not isinstance(hi, bytes):
+                continue
+            size = len(lo)
+            lengths.add(size)
+            start, end = int.from_bytes(lo, "big"), int.from_bytes(hi, "big")
+            for k, code in enumerate(range(start, min(end, start + 0xffff) + 1)):
+                if isinstance(dsts, list):
+                    if k >= len(dsts):
+                        break
+                    dst = dsts[k]
+                else:
+                    # The last byte of the destination is incremented
+                    dst = dsts[:-1] + bytes([(dsts[-1] + k) & 0xff]) if dsts else b""
+                if isinstance(dst, bytes):
+                    self.cmap[code.to_bytes(size, "big")] = dst.decode("utf-16-be", "replace")
+
+
+
+    def decode(self, s):
+        if self.cmap is not None:
+            out = []
+            i = 0
+            while i < len(s):
+                for n in self.lengths:
+                    code = s[i:i + n]
+                    if code in self.cmap:
+                        out.append(self.cmap[code])
+                        i += n
+                        break
+                else:
+                    i += self.lengths[-1]
+            return "".join(out)
+
+        if self.codelen == 2:
+            # CIDs without ToUnicode can't be mapped to characters
+            return ""
+
+        return "".join(self.differences.get(b) or bytes([b]).decode(self.codec, "replace") for b in s)
+
+
+
+class _Interpreter(object):
+    def __init__(self, doc):
+        self.doc = doc
+        self.out = []
+        self._fonts = {}
+        self._lasty = None
+
+
+
+    def _font(self, resources, name):
+        fonts = self.doc.resolve(resources.get("Font")) or {}
+        ref = fonts.get(name)
+        key = ref if isinstance(ref, Ref) else (id(fonts), name)
+        if key not in self._fonts:
+            font = self.doc.resolve(ref)
+            self._fonts[key] = Font(self.doc, font) if isinstance(font, dict) else None
+        return self._fonts[key]
+
+
+
+    def _newline(self):
+        if self.out and self.out[-1] != "\n":
+            self.out.append("\n")
+
+
+
+    def _space(self):
+        if self.out and self.out[-1] not in " \n":
+            self.out.append(" ")
+
+
+
+    def run(self, content, resources, depth=0):
+        lexer = _Lexer(content)
+        operands = []
+        font = None
+
+        while True:
+            token = lexer.next()
+            if token is None:
+                break
+            if not isinstance(token, Keyword) or token in ("<<", "["):
+                if isinstance(token, Keyword):
+                    lexer.push(token)
+                    token = lexer.object()
+                operands.append(token)
+                continue
+
+            if token == "Tf" and len(operands) >= 2:
+                font = self._font(resources, operands[-2])
+            elif token in ("Tj", "'", '"') and operands:
+                if token != "Tj":
+                    self._newline()
+                if font is not None and isinstance(operands[-1], bytes):
+                    self.out.append(font.decode(operands[-1]))
+            elif token == "TJ" and operands and isinstance(operands[-1], list):
+                for item in operands[-1]:
+                    if isinstance(item, bytes) and font is not None:
+                        self.out.append(font.decode(item))
+                    elif isinstance(item, (int, float)) and item < -120:
+                        self._space()
+            elif token in ("Td", "TD") and len(operands) >= 2:
+                if operands[-1] != 0:
+                    self._newline()
+                else:
+                    self._space()
+            elif token == "Tm" and len(operands) >= 6:
+                y = operands[-1]
+                if self._lasty is not None and y == self._lasty:
+                    self._space()
+                else:
+                    self._newline()
+                self._lasty = y
+            elif token in ("T*", "ET"):
+                self._newline()
+            elif token == "Do" and operands and depth < 8:
+                self._form(resources, operands[-1], depth)
+
+            operands = []
+
+
+
+    def _form(self, resources, name, depth):
+        xobjects = self.doc.resolve(resources.get("XObject")) or {}
+        form = self.doc.resolve(xobjects.get(name))
+        if isinstance(form, Stream) and form.attrs.get("Subtype") == "Form":
+            try:
+                content = form.data()
+            except (ValueError, zlib.error):
+                return
+            self.run(content, self.doc.resolve(form.attrs.get("Resources")) or resources, depth + 1)
+
+
+
+def extract_text(data):
+    """Return the text of a PDF, one string with a line per text line and a
+    blank line between the pages."""
+    doc = Document(data)
+    pages = []
+
+    for page, resources in doc.pages():
+        contents = doc.resolve(page.get("Contents"))
+        if not isinstance(contents, list):
+            contents = [contents]
+
+        content = b""
+        for c in contents:
+            c = doc.resolve(c)
+            if isinstance(c, Stream):
+                try:
+                    content += c.data() + b"\n"
+                except (ValueError, zlib.error):
+                    continue
+
+        interp = _Interpreter(doc)
+        interp.run(content, resources)
+        lines = (re.sub(r"[ \t]+", " ", l).strip() for l in "".join(interp.out).split("\n"))
+        pages.append("\n".join(l for l in lines if l))
+
+    return "\n\n".join(p for p in pages if p)
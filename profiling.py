@@ -0,0 +1,169 @@
+"""Phase-level profiling, enabled with --profile.
+
+The named phases (login, listing, download, ...) are wrapped with phase() or
+profiled(). When profiling is enabled, each phase records its wall time and
+CPU time, and the phases of the main thread (the one that enabled profiling)
+are also profiled with cProfile and record their peak memory allocations
+(tracemalloc). Only one cProfile profiler can be active at a time and the
+tracemalloc peak is process-wide: the peak of a main thread phase includes
+what the other threads, such as the mailer sender thread, allocated during
+it. When profiling is disabled the phases cost a global lookup."""
+
+import contextlib
+import functools
+import threading
+import time
+
+# cProfile, pstats and tracemalloc are only imported when enabled
+
+
+
+_profiler = None
+_nullcontext = contextlib.nullcontext()
+
+
+
+class _Frame(object):
+    __slots__ = ("name", "wall", "cpu", "mem", "peak")
+
+    def __init__(self, name, wall, cpu, mem):
+        self.name = name
+        self.wall = wall
+        self.cpu = cpu
+        self.mem = mem
+        self.peak = 0
+
+
+
+class Profiler(object):
+    def __init__(self):
+        import cProfile
+        import tracemalloc
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._main = threading.get_ident()
+        self._profile = cProfile.Profile()
+        self._phases = {}
+        tracemalloc.start()
+
+
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        import tracemalloc
+
+        stack = self._stack()
+        # The profiler and the memory peak are shared by all the threads,
+        # leave them to the main thread
+        main = threading.get_ident() == self._main
+        mem = None
+        if main:
+            if not stack:
+                # cProfile can't be enabled twice, only profile outermost phases
+                self._profile.enable()
+
+            mem, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+
+        frame = _Frame(name, time.perf_counter(), time.thread_time(), mem)
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - frame.wall
+            cpu = time.thread_time() - frame.cpu
+            stack.pop()
+
+            peak = None
+            if main:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, frame.peak)
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, peak)
+                else:
+                    self._profile.disable()
+
+            with self._lock:
+                stats = self._phases.setdefault(name, [0, 0.0, 0.0, None])
+                stats[0] += 1
+                stats[1] += wall
+                stats[2] += cpu
+                if peak is not None:
+                    stats[3] = max(stats[3] or 0, peak - frame.mem)
+
+
+
+    def summary(self):
+        lines = ["%-15s %6s %10s %10s %12s" % ("phase", "count", "wall s", "cpu s", "peak KiB")]
+        with self._lock:
+            phases = sorted(self._phases.items(), key=lambda p: -p[1][1])
+            for name, (count, wall, cpu, peak) in phases:
+                peak = "%12.1f" % (peak / 1024) if peak is not None else "%12s" % "-"
+                lines.append("%-15s %6d %10.3f %10.3f %s" % (name, count, wall, cpu, peak))
+        return "\n".join(lines) + "\n"
+
+
+
+    def dump(self, path):
+        """Write the merged cProfile data to path and the phase summary to
+        path.txt. Return the summary."""
+        import pstats
+
+        if self._profile.getstats():
+            pstats.Stats(self._profile).dump_stats(path)
+
+        summary = self.summary()
+        with open(path + ".txt", "w") as fp:
+            fp.write(summary)
+        return summary
+
+
+
+def enable():
+    global _profiler
+    _profiler = Profiler()
+
+
+
+def enabled():
+    return _profiler is not None
+
+
+
+def phase(name):
+    """Context manager wrapping a named phase."""
+    if _profiler is None:
+        return _nullcontext
+    return _profiler.phase(name)
+
+
+
+def profiled(name):
+    """Decorator wrapping every call of a function in a named phase."""
+    def deco(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+
+def dump(path):
+    if _profiler is None:
+        return None
+    return _profiler.dump(path)
@@ -0,0 +1,184 @@
+"""Token bucket rate limiting of the requests to the site, one bucket per
+host, shared by all the threads of the process. The buckets can also be
+shared between processes through a state file per host.
+
+Tokens are reserved before sleeping: a caller takes a token even if the
+bucket is empty and sleeps until it would have been refilled. Concurrent
+callers are thus served in order, each waiting for its own slot."""
+
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+import profiling
+
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._last = time.monotonic()
+
+
+
+    def _take(self, tokens, last, now):
+        """Take a token and return the new token count along with the time
+        to wait for it."""
+        tokens = min(self.burst, tokens + (now - last) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+
+
+    def reserve(self):
+        """Take a token and return the time to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, wait = self._take(self._tokens, self._last, now)
+            self._last = now
+        return wait
+
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket whose state is kept in a file locked with flock, shared
+    by all the processes using the same file."""
+
+    def __init__(self, path, rate, burst):
+        super(FileTokenBucket, self).__init__(rate, burst)
+        self._path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+
+    def reserve(self):
+        with self._lock:
+            fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                now = time.time()
+                try:
+                    tokens, last = json.loads(os.pread(fd, 256, 0))
+                except ValueError:
+                    tokens, last = self.burst, now
+
+                tokens, wait = self._take(tokens, min(last, now), now)
+                data = json.dumps([tokens, now]).encode()
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, data, 0)
+            finally:
+                os.close(fd)
+        return wait
+
+
+
+class RateLimiter(object):
+    """One token bucket per host. rates maps host names to (rate, burst),
+    the other hosts use the default. A rate of None disables the limit."""
+
+    def __init__(self, default=(None, None), rates=None, statedir=None):
+        self._default = default
+        self._rates = rates or {}
+        self._statedir = statedir
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._stats = {}
+
+
+
+    def _bucket(self, host):
+        with self._lock:
+            if host in self._buckets:
+                return self._buckets[host]
+
+            rate, burst = self._rates.get(host, self._default)
+            if rate is None:
+                bucket = None
+            elif self._statedir is not None:
+                bucket = FileTokenBucket(os.path.join(self._statedir, host), rate, burst)
+            else:
+                bucket = TokenBucket(rate, burst)
+
+            self._buckets[host] = bucket
+            self._stats[host] = [0, 0, 0.0, 0.0]
+            return bucket
+
+
+
+    def wait(self, url):
+        """Wait until a request to url is allowed."""
+        host = urllib.parse.urlsplit(url).hostname
+        bucket = self._bucket(host)
+        wait = bucket.reserve() if bucket is not None else 0
+
+        with self._lock:
+            stats = self._stats[host]
+            stats[0] += 1
+            if wait > 0:
+                stats[1] += 1
+                stats[2] += wait
+                stats[3] = max(stats[3], wait)
+
+        if wait > 0:
+            logging.debug("Rate limit: waiting %.3fs before requesting %s", wait, host)
+            with profiling.phase("rate limit"):
+                time.sleep(wait)
+
+
+
+    def stats(self):
+        """Return {host: (requests, waits, seconds waited, longest wait)}."""
+        with self._lock:
+            return {host: tuple(s) for host, s in self._stats.items()}
+
+
+
+    def summary(self):
+        lines = ["%-40s %8s %6s %10s %10s" % ("host", "requests", "waits", "waited s", "max s")]
+        for host, (count, waits, waited, longest) in sorted(self.stats().items()):
+            lines.append("%-40s %8d %6d %10.3f %10.3f" % (host, count, waits, waited, longest))
+        return "\n".join(lines) + "\n"
+
+
+
+limiter = RateLimiter()
+
+
+
+def configure(default=(None, None), rates=None, statedir=None):
+    """Replace the shared limiter."""
+    global limiter
+    limiter = RateLimiter(default, rates, statedir)
+    return limiter
+
+
+
+def parserate(value):
+    """Parse "rate" or "rate/burst". A rate of 0 disables the limit."""
+    rate, _, burst = value.partition("/")
+    rate = float(rate)
+    if rate <= 0:
+        return None, None
+    return rate, float(burst) if burst else max(1.0, rate)
+
+
+
+def configure_from(config, statedir):
+    """Configure the shared limiter from the [RateLimit] section: "rate" is
+    the default rate per host, keys with a dot are host names, and "shared"
+    shares the buckets with the other processes. Without the section the
+    requests aren't limited."""
+    if not config.has_section("RateLimit"):
+        return configure()
+
+    section = config["RateLimit"]
+    default = parserate(section.get("rate", "5/10"))
+    rates = {k: parserate(v) for k, v in section.items() if "." in k}
+    shared = config.getboolean("RateLimit", "shared", fallback=False)
+    return configure(default, rates, os.path.join(statedir, "ratelimit") if shared else None)
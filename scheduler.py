@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""Actualise all the configured accounts during the monthly window.
+
+The situation of every account is read first. Only the accounts whose
+period is open and that weren't actualised by us for that period are
+queued, ordered by deadline (dateFin), and actualised by a bounded number of
+workers. The accounts that failed are retried until their deadline, and a
+single report is sent at the end."""
+
+import argparse
+import concurrent.futures
+import configparser
+import datetime
+import locale
+import logging
+import logging.config
+import os
+import sys
+import time
+import traceback
+
+import accountlock
+import autovalidate
+import mailer
+import outbox
+import paulemploi
+import ratelimit
+import transport
+
+
+
+# Outcomes of an account
+DECLARED = "actualisé"
+PENDING = "actualisé, mail de confirmation non envoyé"
+ALREADY = "déjà actualisé"
+NOPERIOD = "pas d'actualisation en cours"
+FAILED = "échec"
+MISSED = "échec, date limite dépassée"
+
+
+
+class Job(object):
+    def __init__(self, config, section):
+        self.config = config
+        self.account = paulemploi.Account(config, section)
+        work = config[section].get("work", "")
+        self.workfiles = [os.path.expanduser(w) for w in work.replace(",", " ").split()]
+        self.periode = None
+        self.deadline = None
+        self.outcome = None
+        self.error = None
+
+
+
+    @property
+    def name(self):
+        return self.account.name
+
+
+
+    def _setperiode(self, periode):
+        self.periode = periode
+        if periode is not None and "dateFin" in periode:
+            self.deadline = datetime.datetime.fromisoformat(periode["dateFin"])
+
+
+
+    def survey(self):
+        """Read the state of the account. Return True if it has to be
+        actualised."""
+        declared = self.account.declared()
+        if declared is not None and "dateFin" in declared:
+            if datetime.datetime.fromisoformat(declared["dateFin"]) >= datetime.datetime.now():
+                # Still in the window we declared, no need to log in
+                self._setperiode(declared)
+                self.outcome = ALREADY
+                return False
+
+        situation = self.account.pe.getSituationsUtilisateur(force=True)
+        self.account.history.record(situation)
+        self._setperiode(situation['actualisation'].get('periodeCourante'))
+
+        if self.periode is None:
+            self.outcome = NOPERIOD
+            return False
+
+        if declared is not None and declared.get("reference") == self.periode["reference"]:
+            self.outcome = ALREADY
+            return False
+
+        return True
+
+
+
+    def actualise(self):
+        config = self.config
+        section = self.account.section
+
+        smtp = None
+        smtpuser = None
+        if config.has_section("SMTP"):
+            # A connection per worker, the backends aren't thread safe
+            smtp, smtpuser = paulemploi.smtp_backend(config["SMTP"])
+
+        backend = paulemploi.delivery_backend(config[section], smtp)
+        mailsender = mailer.Mailer(backend, smtpuser or self.account.email)
+        spool = outbox.Outbox(os.path.join(self.account.statedir, "outbox"), mailsender)
+
+        with accountlock.AccountLock(os.path.join(self.account.statedir, "lock")):
+            # Another run may have actualised it while we waited for the lock
+            declared = self.account.declared()
+            if declared is not None and declared.get("reference") == self.periode["reference"]:
+                logging.info("Account %s was actualised by another run", self.name)
+                self.outcome = ALREADY
+                return
+
+            accepted = []
+
+            def markdeclared(periode):
+                # Recorded before anything else can fail, the site must
+                # never be sent the declaration twice
+                self.account.mark_declared(periode)
+                accepted.append(periode)
+
+            try:
+                with mailsender:
+                    autovalidate.dostuff(spool, self.account.email, self.account.pe, self.workfiles, self.account.history, markdeclared)
+                spool.check()
+            except Exception as e:
+                if not accepted:
+                    raise
+                logging.exception("Account %s actualised but the confirmation wasn't delivered", self.name)
+                self.outcome = PENDING
+                self.error = e
+                return
+
+        self.outcome = DECLARED
+
+
+
+    def run(self, step):
+        """Run the survey or actualise step, recording the error if any."""
+        memoryHandler = paulemploi.logging_getHandler("memoryHandler")
+        with memoryHandler.account(self.account.section):
+            try:
+                return step()
+            except Exception as e:
+                logging.exception("%s failed for account %s", step.__name__, self.name)
+                self.outcome = FAILED
+                self.error = e
+                # The session may have expired, log in again next time
+                self.account.reset()
+                return False
+
+
+
+def runround(pool, jobs):
+    """Survey and actualise the jobs. Return the jobs that failed."""
+    surveyed = list(pool.map(lambda job: job.run(job.survey), jobs))
+    queue = [job for job, todo in zip(jobs, surveyed) if todo]
+
+    farfuture = datetime.datetime.max
+    queue.sort(key=lambda job: job.deadline or farfuture)
+    for job in queue:
+        logging.info("Queued account %s, deadline %s", job.name, job.deadline)
+
+    # The pool runs them in submission order, earliest deadline first
+    list(pool.map(lambda job: job.run(job.actualise), queue))
+    return [job for job in jobs if job.outcome == FAILED]
+
+
+
+def report(jobs):
+    lines = []
+    for job in jobs:
+        line = "%s: %s" % (job.name, job.outcome)
+        if job.periode is not None:
+            ref = datetime.datetime.fromisoformat(job.periode["reference"])
+            line += " (%s)" % ref.strftime("%B %Y")
+        if job.error is not None and job.outcome in (FAILED, MISSED, PENDING):
+            line += "\n    %r" % job.error
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+
+def main():
+    locale.setlocale(locale.LC_ALL, '')
+    logging.config.fileConfig(os.path.join(paulemploi.SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Actualise tous les comptes pendant la période d'actualisation")
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("--user", "-u", metavar="PEusername", action="append", help="Compte configuré à actualiser, peut être répété. Par défaut tous")
+    parser.add_argument("--concurrency", "-c", type=int, help="Nombre de comptes actualisés en parallèle")
+    parser.add_argument("--retry-delay", metavar="SECONDES", type=float, help="Délai entre deux tentatives pour les comptes en échec")
+    parser.add_argument("--max-wait", metavar="SECONDES", type=float, default=86400, help="Durée maximale des nouvelles tentatives pour les comptes sans date limite connue")
+    parser.add_argument("--once", action="store_true", help="Ne réessaie pas les comptes en échec")
+    parser.add_argument("--no-send", "-n", action="store_true", help="N'envoie pas le rapport par mail, l'affiche seulement")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+    paulemploi.setverbosity(args.verbose - args.quiet)
+
+    config = configparser.ConfigParser()
+    config.read(args.cfgfile)
+
+    ratelimit.configure_from(config, paulemploi.statedir(config))
+    transport.configure_from(config)
+
+    concurrency = args.concurrency or config.getint("Schedule", "concurrency", fallback=4)
+    retrydelay = args.retry_delay
+    if retrydelay is None:
+        retrydelay = config.getfloat("Schedule", "retrydelay", fallback=1800)
+
+    sections = [s for s in config.sections() if s.startswith("Account.")]
+    if args.user:
+        sections = ["Account." + u for u in args.user]
+    if not sections:
+        logging.error("No account configured in %s", args.cfgfile)
+        return 1
+    for s in sections:
+        if s not in config:
+            logging.error("No account %s in %s", s[len("Account."):], args.cfgfile)
+            return 1
+    jobs = [Job(config, s) for s in sections]
+
+    giveup = time.time() + args.max_wait
+    pending = jobs
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        while True:
+            failed = runround(pool, pending)
+            if not failed or args.once:
+                break
+
+            nexttry = datetime.datetime.now() + datetime.timedelta(seconds=retrydelay)
+            pending = []
+            for job in failed:
+                if job.deadline is not None and job.deadline < nexttry:
+                    job.outcome = MISSED
+                elif job.deadline is None and time.time() + retrydelay > giveup:
+                    job.outcome = MISSED
+                else:
+                    pending.append(job)
+
+            if not pending:
+                break
+
+            logging.info("Retrying %d accounts in %ds", len(pending), retrydelay)
+            time.sleep(retrydelay)
+            for job in pending:
+                job.outcome = job.error = None
+
+    msg = report(jobs)
+    sys.stdout.write(msg)
+
+    failed = [job for job in jobs if job.outcome in (FAILED, MISSED)]
+    if not args.no_send:
+        memoryHandler = paulemploi.logging_getHandler("memoryHandler")
+        logs = [("%s.log.gz" % job.name, memoryHandler.gzipped(job.account.section))
+                for job in jobs if job.outcome in (FAILED, MISSED, PENDING)]
+
+        if config.has_section("SMTP"):
+            backend, dest = paulemploi.smtp_backend(config["SMTP"])
+        else:
+            backend, dest = paulemploi.delivery_backend(config[sections[0]], None), jobs[0].account.email
+
+        try:
+            with mailer.Mailer(backend, dest) as reporter:
+                reporter.message(dest, "Rapport d'actualisation", msg, logs)
+        except Exception:
+            logging.error("Could not send the report:\n%s", traceback.format_exc())
+            return 1
+
+    return 1 if failed else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""Full-text index of the courriers.
+
+The text of each courrier is extracted from its PDF when it's downloaded
+and indexed in a SQLite FTS5 table along with the account, date, title and
+channel. Documents are identified by the SHA-256 of their PDF so that each
+one is only processed once. Searching only reads the index, it never opens
+a PDF nor connects to the site."""
+
+import argparse
+import configparser
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+
+import pdftext
+import profiling
+
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS courriers (
+    id INTEGER PRIMARY KEY,
+    sha TEXT NOT NULL,
+    account TEXT NOT NULL,
+    date TEXT,
+    title TEXT,
+    channel TEXT,
+    indexed TEXT,
+    UNIQUE (sha, account)
+);
+CREATE INDEX IF NOT EXISTS courriers_date ON courriers (date);
+CREATE VIRTUAL TABLE IF NOT EXISTS courriers_text USING fts5 (
+    title, body, tokenize = "unicode61 remove_diacritics 2"
+);
+"""
+
+
+
+class Index(object):
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        # Several runs may index concurrently
+        self._db = sqlite3.connect(self._path, timeout=30)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+
+
+
+    def close(self):
+        self._db.close()
+
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+    def has(self, sha, account):
+        cur = self._db.execute("SELECT 1 FROM courriers WHERE sha = ? AND account = ?", (sha, account))
+        return cur.fetchone() is not None
+
+
+
+    @profiling.profiled("indexing")
+    def add(self, account, date, title, channel, pdf):
+        """Index a courrier unless it's already indexed. Return whether it
+        was added."""
+        sha = hashlib.sha256(pdf).hexdigest()
+        if self.has(sha, account):
+            logging.debug("Courrier %r already indexed", title)
+            return False
+
+        try:
+            body = pdftext.extract_text(pdf)
+        except Exception as e:
+            # Indexed with its title only, not to try again every time
+            logging.warning("Could not extract the text of %r: %r", title, e)
+            body = ""
+
+        with self._db:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO courriers (sha, account, date, title, channel, indexed) VALUES (?, ?, ?, ?, ?, ?)",
+                (sha, account, date.isoformat() if date else None, title, channel,
+                 datetime.datetime.now().isoformat(timespec="seconds")))
+            if cur.rowcount == 0:
+                return False
+            self._db.execute("INSERT INTO courriers_text (rowid, title, body) VALUES (?, ?, ?)",
+                             (cur.lastrowid, title, body))
+
+        logging.debug("Indexed courrier %r, %d characters", title, len(body))
+        return True
+
+
+
+    @staticmethod
+    def _quote(query):
+        """Query made of the words of query, without FTS5 operators."""
+        return " ".join('"%s"' % w.replace('"', '""') for w in query.split())
+
+
+
+    def search(self, query, account=None, limit=20):
+        """Return the (account, date, title, channel, snippet) of the
+        courriers matching the FTS5 query, best matches first."""
+        sql = ("SELECT c.account, c.date, c.title, c.channel, "
+               "snippet(courriers_text, 1, '[', ']', '...', 12) "
+               "FROM courriers_text JOIN courriers c ON c.id = courriers_text.rowid "
+               "WHERE courriers_text MATCH ?")
+        params = []
+        if account is not None:
+            sql += " AND c.account = ?"
+            params.append(account)
+        sql += " ORDER BY bm25(courriers_text, 5.0, 1.0) LIMIT ?"
+
+        try:
+            return self._db.execute(sql, [query] + params + [limit]).fetchall()
+        except sqlite3.OperationalError:
+            # Not a valid FTS5 query, search the words
+            return self._db.execute(sql, [self._quote(query)] + params + [limit]).fetchall()
+
+
+
+def indexpath(statedir):
+    return os.path.join(statedir, "courriers.sqlite")
+
+
+
+def main():
+    import paulemploi
+
+    parser = argparse.ArgumentParser(description="Recherche dans le texte des courriers déjà récupérés")
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("query", nargs="+", help="Mots à chercher, ou requête FTS5 (\"mot1 OR mot2\", \"préfixe*\", ...)")
+    parser.add_argument("--user", "-u", metavar="PEusername", help="Ne cherche que dans les courriers de ce compte")
+    parser.add_argument("--limit", type=int, default=20, help="Nombre maximal de résultats")
+
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.cfgfile)
+
+    path = indexpath(paulemploi.statedir(config))
+    if not os.path.exists(path):
+        print("Aucun courrier indexé", file=sys.stderr)
+        return 1
+
+    with Index(path) as index:
+        results = index.search(" ".join(args.query), args.user, args.limit)
+
+    for account, date, title, channel, snippet in results:
+        print("%s  %-10s %s (%s)" % (date, account, title, channel))
+        print("    " + " ".join(snippet.split()))
+
+    return 0 if results else 1
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
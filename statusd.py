@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+"""Local HTTP service serving the situation, indemnisation and unread count
+of the configured accounts from a cache, so that other tools don't have to log
+in to the site themselves.
+
+Each value is kept for a TTL. A request for a value that is too old returns
+it as is and refreshes it in the background. Concurrent requests for a value
+being fetched share the same upstream call, so that any number of readers
+cost at most one call to the site per value and TTL."""
+
+import argparse
+import configparser
+import http.server
+import json
+import logging
+import logging.config
+import os
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+import paulemploi
+import ratelimit
+import transport
+
+
+
+class CachedValue(object):
+    """Value fetched with fetch() and kept for ttl seconds."""
+
+    # Delay before fetching again a value whose refresh failed
+    retrydelay = 60
+
+    def __init__(self, name, fetch, ttl):
+        self.name = name
+        self._fetch = fetch
+        self._ttl = ttl
+        self._cond = threading.Condition()
+        self._value = None
+        self._time = None
+        self._error = None
+        self._retryat = 0
+        self._fetching = False
+
+
+
+    def _refresh(self):
+        try:
+            value = self._fetch()
+        except Exception as e:
+            logging.exception("Could not refresh %s", self.name)
+            with self._cond:
+                self._error = e
+                self._retryat = time.time() + min(self._ttl, self.retrydelay)
+                self._fetching = False
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            self._value = value
+            self._time = time.time()
+            self._error = None
+            self._fetching = False
+            self._cond.notify_all()
+        logging.debug("Refreshed %s", self.name)
+
+
+
+    def get(self):
+        """Return (value, time of the fetch). The value may be stale, in
+        which case a refresh is started in the background. Wait for the fetch
+        only when there's no value yet."""
+        with self._cond:
+            now = time.time()
+            stale = self._time is None or now - self._time > self._ttl
+            if stale and not self._fetching and now >= self._retryat:
+                self._fetching = True
+                threading.Thread(target=self._refresh, name="refresh " + self.name, daemon=True).start()
+
+            if self._time is None:
+                if not self._fetching:
+                    # The last refresh failed recently
+                    raise self._error
+                while self._fetching:
+                    self._cond.wait()
+                if self._time is None:
+                    raise self._error
+
+            return self._value, self._time
+
+
+
+class AccountStatus(object):
+    def __init__(self, account, situationttl, unreadttl):
+        self.account = account
+        # A single session per account, used by one refresh at a time
+        self._lock = threading.Lock()
+        self.situation = CachedValue(account.name + " situation", self._situation, situationttl)
+        self.unread = CachedValue(account.name + " unread", self._unread, unreadttl)
+
+
+
+    def _call(self, func):
+        with self._lock:
+            try:
+                return func(self.account.pe)
+            except Exception:
+                # The session may have expired, log in again next time
+                self.account.reset()
+                raise
+
+
+
+    def _situation(self):
+        situation = self._call(lambda pe: pe.getSituationsUtilisateur(force=True))
+        self.account.history.record(situation)
+        return situation
+
+
+
+    def _unread(self):
+        return self._call(lambda pe: pe.count_unread())
+
+
+
+    def query(self, what):
+        """Return the value for what along with the time it was fetched."""
+        if what == "situation":
+            return self.situation.get()
+        if what == "indemnisation":
+            situation, t = self.situation.get()
+            return situation.get("indemnisation"), t
+        if what == "unread":
+            return self.unread.get()
+        raise KeyError(what)
+
+
+
+QUERIES = ["situation", "indemnisation", "unread"]
+
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """GET /accounts, /<account> or /<account>/<query>."""
+
+    def address_string(self):
+        # Clients have no address on a unix socket
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+    def _answer(self, status, what):
+        value, t = status.query(what)
+        return {"value": value, "fetched": t, "age": time.time() - t}
+
+
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        accounts = self.server.accounts
+
+        if path == ["accounts"]:
+            self._reply(200, sorted(accounts))
+            return
+
+        if len(path) not in (1, 2) or path[0] not in accounts:
+            self._reply(404, {"error": "Not found"})
+            return
+
+        status = accounts[path[0]]
+        queries = path[1:] or QUERIES
+        if queries[0] not in QUERIES:
+            self._reply(404, {"error": "Unknown query %r" % queries[0]})
+            return
+
+        try:
+            answer = {q: self._answer(status, q) for q in queries}
+        except Exception as e:
+            self._reply(502, {"error": repr(e)})
+            return
+
+        self._reply(200, answer[queries[0]] if path[1:] else answer)
+
+
+
+class TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+
+class UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+
+def make_server(listen, accounts):
+    """Listen on "host:port" or "unix:/path/to/socket"."""
+    if listen.startswith("unix:"):
+        path = os.path.expanduser(listen[len("unix:"):])
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixServer(path, Handler)
+        os.chmod(path, 0o600)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = TCPServer((host or "127.0.0.1", int(port)), Handler)
+
+    server.accounts = accounts
+    return server
+
+
+
+def main():
+    logging.config.fileConfig(os.path.join(paulemploi.SELFPATH, "logconf.ini"), disable_existing_loggers=False)
+
+    parser = argparse.ArgumentParser(description="Service local donnant l'état des comptes Paul Emploi")
+    parser.add_argument("cfgfile", metavar="configfile", help="Fichier de configuration")
+    parser.add_argument("--user", "-u", metavar="PEusername", action="append", help="Compte configuré à servir, peut être répété. Par défaut tous")
+    parser.add_argument("--listen", "-l", metavar="ADRESSE", help="hôte:port ou unix:/chemin/de/la/socket")
+    parser.add_argument("--verbose", "-v", action="count", default=0, help="Augmente le niveau de verbosité")
+    parser.add_argument("--quiet", "-q", action="count", default=0, help="Diminue le niveau de verbosité")
+
+    args = parser.parse_args()
+    paulemploi.setverbosity(args.verbose - args.quiet)
+
+    config = configparser.ConfigParser()
+    config.read(args.cfgfile)
+
+    sections = [s for s in config.sections() if s.startswith("Account.")]
+    if args.user:
+        sections = ["Account." + u for u in args.user]
+    for s in sections:
+        if s not in config:
+            logging.error("No account %s in %s", s[len("Account."):], args.cfgfile)
+            return 1
+
+    ratelimit.configure_from(config, paulemploi.statedir(config))
+    transport.configure_from(config)
+
+    situationttl = config.getfloat("Status", "situationttl", fallback=600)
+    unreadttl = config.getfloat("Status", "unreadttl", fallback=300)
+    listen = args.listen or config.get("Status", "listen", fallback="127.0.0.1:8437")
+
+    accounts = {}
+    for s in sections:
+        account = paulemploi.Account(config, s)
+        accounts[account.name] = AccountStatus(account, situationttl, unreadttl)
+
+    server = make_server(listen, accounts)
+    logging.info("Serving %d accounts on %s", len(accounts), listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
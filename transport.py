@@ -0,0 +1,108 @@
+"""Connection pool shared by the sessions of all the accounts.
+
+Every account has its own requests.Session holding its cookies and headers,
+but they all send their requests through the same HTTPAdapter. Its urllib3
+pools keep the connections to each host alive, so that a process handling
+many accounts reuses warm connections instead of doing a TCP and TLS
+handshake for each account."""
+
+import logging
+import socket
+import threading
+
+# requests is imported where it's used
+
+
+
+_lock = threading.Lock()
+_adapter = None
+_settings = {"poolsize": 10, "pools": 10, "keepalive": 60}
+
+
+
+def _adapterclass():
+    import requests.adapters
+
+    class SharedAdapter(requests.adapters.HTTPAdapter):
+        """Adapter that stays open when a session using it is closed."""
+
+        def __init__(self, keepalive, **kwargs):
+            self._keepalive = keepalive
+            super(SharedAdapter, self).__init__(**kwargs)
+
+        def init_poolmanager(self, *args, **kwargs):
+            import urllib3.connection
+
+            options = list(urllib3.connection.HTTPConnection.default_socket_options)
+            if self._keepalive:
+                # Detect the connections dropped while idle in the pool
+                options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+                if hasattr(socket, "TCP_KEEPIDLE"):
+                    options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self._keepalive))
+            kwargs["socket_options"] = options
+            super(SharedAdapter, self).init_poolmanager(*args, **kwargs)
+
+        def close(self):
+            pass
+
+        def closeall(self):
+            super(SharedAdapter, self).close()
+
+    return SharedAdapter
+
+
+
+def configure(poolsize=10, pools=10, keepalive=60):
+    """Set the size of the pools: the number of connections kept per host,
+    the number of hosts, and the idle time in seconds before TCP keepalive
+    probes are sent (0 to disable them). Only affects the adapter if it
+    wasn't created yet."""
+    _settings.update(poolsize=poolsize, pools=pools, keepalive=keepalive)
+
+
+
+def configure_from(config):
+    """Configure the pools from the [HTTP] section."""
+    configure(config.getint("HTTP", "poolsize", fallback=10),
+              config.getint("HTTP", "pools", fallback=10),
+              config.getint("HTTP", "keepalive", fallback=60))
+
+
+
+def adapter():
+    """The shared adapter, created on first use."""
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            logging.debug("Creating the shared connection pool %r", _settings)
+            _adapter = _adapterclass()(_settings["keepalive"],
+                                       pool_connections=_settings["pools"],
+                                       pool_maxsize=_settings["poolsize"])
+        return _adapter
+
+
+
+def session():
+    """A new session with its own cookies and headers, using the shared
+    connection pools."""
+    import requests
+    import urllib3.util
+
+    s = requests.Session()
+    a = adapter()
+    s.mount("https://", a)
+    s.mount("http://", a)
+
+    # gzip and deflate, plus br and zstd if urllib3 can decode them
+    s.headers["Accept-Encoding"] = urllib3.util.make_headers(accept_encoding=True)["accept-encoding"]
+    return s
+
+
+
+def close():
+    """Close all the pooled connections."""
+    global _adapter
+    with _lock:
+        if _adapter is not None:
+            _adapter.closeall()
+            _adapter = None
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import csv
+import datetime
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+
+def cachepath():
+    cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cachedir, "paulemploi", "workfile.json")
+
+
+
+def monthkey(date):
+    return "%04d-%02d" % (date.year, date.month)
+
+
+
+def _checkdate(date, seen):
+    """Return the YYYY-MM key of an ISO date, or None if it's not one."""
+    month = seen.get(date)
+    if month is not None:
+        return month
+
+    # fromisoformat also takes other ISO formats such as week dates
+    if len(date) != 10 or date[4] != "-" or date[7] != "-":
+        return None
+
+    try:
+        datetime.date.fromisoformat(date)
+    except ValueError:
+        return None
+
+    month = date[:7]
+    seen[date] = month
+    return month
+
+
+
+def _add(months, seen, fields, path, lineno):
+    date, hours, rate = fields[:3]
+    month = _checkdate(date, seen)
+    if month is None:
+        raise ValueError("Ill-formatted date in workfile %s:%d: %r" % (path, lineno, date))
+
+    try:
+        hours = float(hours)
+        rate = float(rate)
+    except ValueError:
+        raise ValueError("Ill-formatted line in workfile %s:%d: %r" % (path, lineno, fields)) from None
+
+    tot = months.get(month)
+    if tot is None:
+        tot = months[month] = [0.0, 0.0]
+    tot[0] += hours
+    tot[1] += hours * rate
+
+
+
+def _parse_text(fp, path):
+    months = {}
+    seen = {}
+
+    for lineno, line in enumerate(fp, 1):
+        if "#" in line:
+            line = line.split("#", 1)[0]
+
+        fields = line.split()
+        if not fields:
+            continue
+
+        if len(fields) < 3:
+            raise ValueError("Ill-formatted line in workfile %s:%d: %r" % (path, lineno, line))
+
+        _add(months, seen, fields, path, lineno)
+
+    return months
+
+
+
+def _parse_csv(fp, path):
+    months = {}
+    seen = {}
+
+    for lineno, row in enumerate(csv.reader(fp), 1):
+        row = [c.strip() for c in row]
+        if not row or not row[0] or row[0].startswith("#"):
+            continue
+
+        # Allow a header line such as "date,hours,rate"
+        if lineno == 1 and _checkdate(row[0], seen) is None:
+            continue
+
+        if len(row) < 3:
+            raise ValueError("Ill-formatted line in workfile %s:%d: %r" % (path, lineno, row))
+
+        _add(months, seen, row, path, lineno)
+
+    return months
+
+
+
+def parse(path):
+    """Parse a workfile and return a dict {"YYYY-MM": [hours, revenue]}."""
+    logging.info("Parsing workfile: %s", path)
+    with open(path, newline="") as fp:
+        if path.lower().endswith(".csv"):
+            return _parse_csv(fp, path)
+        return _parse_text(fp, path)
+
+
+
+def _load_cache(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable workfile cache %s: %s", path, e)
+        return {}
+
+
+
+def _save_cache(path, cache):
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix=".workfile-")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+
+def monthly_totals(paths, cache=None):
+    """Return the sorted list of (month, hours, revenue) summed over all the
+    workfiles. The per-file monthly aggregates are kept in a cache keyed by
+    path, mtime and size so that unchanged files are never parsed again.
+    Pass cache=False to disable the cache."""
+
+    if cache is None:
+        cache = cachepath()
+
+    entries = _load_cache(cache) if cache else {}
+    dirty = False
+    totals = {}
+
+    for path in paths:
+        realpath = os.path.realpath(path)
+        st = os.stat(realpath)
+        entry = entries.get(realpath)
+
+        if entry is not None and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            logging.debug("Using cached totals for workfile %s", path)
+        else:
+            entry = {"mtime": st.st_mtime_ns, "size": st.st_size, "months": parse(path)}
+            entries[realpath] = entry
+            dirty = True
+
+        for month, (hours, revenue) in entry["months"].items():
+            tot = totals.setdefault(month, [0.0, 0.0])
+            tot[0] += hours
+            tot[1] += revenue
+
+    # Forget the files that were removed
+    for realpath in [p for p in entries if not os.path.exists(p)]:
+        logging.debug("Dropping cached totals of removed workfile %s", realpath)
+        del entries[realpath]
+        dirty = True
+
+    if cache and dirty:
+        try:
+            _save_cache(cache, entries)
+        except OSError as e:
+            logging.warning("Could not write workfile cache %s: %s", cache, e)
+
+    return [(m, h, r) for m, (h, r) in sorted(totals.items())]
+
+
+
+def range_totals(totals, start=None, end=None):
+    """Select the months from start to end (inclusive, "YYYY-MM" strings) in
+    a list returned by monthly_totals."""
+    months = [m for m, _, _ in totals]
+    lo = 0 if start is None else bisect.bisect_left(months, start)
+    hi = len(months) if end is None else bisect.bisect_right(months, end)
+    return totals[lo:hi]
+
+
+
+def month_total(totals, month):
+    months = [m for m, _, _ in totals]
+    i = bisect.bisect_left(months, month)
+    if i < len(months) and months[i] == month:
+        _, hours, revenue = totals[i]
+        return hours, revenue
+    return 0.0, 0.0
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Affiche les totaux mensuels des fichiers d'heures travaillées")
+    parser.add_argument("workfiles", metavar="worklog", nargs="+", help="Fichier des heures travaillées (texte ou .csv)")
+    parser.add_argument("--since", metavar="AAAA-MM", help="Premier mois à afficher")
+    parser.add_argument("--until", metavar="AAAA-MM", help="Dernier mois à afficher")
+    parser.add_argument("--no-cache", action="store_true", help="N'utilise pas le cache des totaux")
+
+    args = parser.parse_args()
+
+    totals = monthly_totals(args.workfiles, cache=False if args.no_cache else None)
+    for month, hours, revenue in range_totals(totals, args.since, args.until):
+        print("%s %8.2f h %10.2f €" % (month, hours, revenue))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())